@@ -2,22 +2,47 @@ import http.server
 import socketserver
 from socketserver import ThreadingMixIn
 import sqlite3
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, unquote
 import json
 from datetime import datetime, timedelta
 import csv
+import codecs
 import io
 import os
-import shutil
 import zipfile
+import shutil
 import re
+from xml.sax.saxutils import escape as xml_escape
 from contextlib import contextmanager
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import queue
 import threading
 import logging
+import logging.handlers
+import argparse
+import atexit
+import asyncio
+import time
+import hashlib
+import functools
+import bisect
+import random
+import gzip
+import zlib
+import mimetypes
+from email.utils import parsedate_to_datetime
 
 PORT = 8501
 
+# HTTP server settings
+SERVER_MODE = 'pool'        # 'pool' (worker threads), 'threaded' (thread per connection) or 'asyncio'
+SERVER_WORKERS = 16         # Worker threads in pool mode
+SERVER_QUEUE_SIZE = 64      # Accepted connections waiting for a worker before we answer 503
+SERVER_RETRY_AFTER = 2      # Seconds suggested to clients that were turned away
+KEEPALIVE_TIMEOUT = 5       # Seconds an idle persistent connection is kept open
+REQUEST_BODY_MAX = 1024 * 1024  # Largest request body accepted by routes without their own limit
+
 # Constants
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'surgery.db')
 SURGERY_USERNAME = "2466"  # Default credentials
@@ -38,39 +63,1032 @@ BACKUP_DIR = os.path.join(BASE_DIR, 'backups')
 os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
 os.makedirs(BACKUP_DIR, exist_ok=True)
 
-# Create a custom handler with UTF-8 encoding
-class UTF8FileHandler(logging.FileHandler):
+LOG_MAX_BYTES = 5 * 1024 * 1024     # Rotate surgery.log at this size
+LOG_BACKUP_COUNT = 5                # Rotated files kept (surgery.log.1 ... .5)
+LOG_READ_BLOCK = 64 * 1024          # Bytes read per step when reading the log backwards
+LOG_PAGE_SIZE = 100                 # Entries returned by /api/database/logs by default
+LOG_PAGE_MAX = 1000
+ACCESS_LOG_FILE = os.path.join(BASE_DIR, 'access.log')
+ACCESS_LOG_ENABLED = True
+ACCESS_LOG_SAMPLE = 1.0             # Fraction of ordinary requests written to access.log
+ACCESS_LOG_SLOW = 1.0               # Seconds; slower requests and 5xx responses are always logged
+
+# Create a custom handler with UTF-8 encoding and size-based rotation
+class UTF8FileHandler(logging.handlers.RotatingFileHandler):
     def __init__(self, filename):
-        super().__init__(filename, encoding='utf-8')
+        super().__init__(filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+
+    def rotate_now(self):
+        """Start a new log file, keeping the current one as surgery.log.1"""
+        self.acquire()
+        try:
+            self.doRollover()
+        finally:
+            self.release()
+
+log_handler = UTF8FileHandler(LOG_FILE)
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', '%Y-%m-%d %H:%M:%S'))
+log_handler.addFilter(lambda record: record.name != 'access')
+
+# Structured access log: one JSON object per line, in its own file
+access_handler = logging.handlers.RotatingFileHandler(
+    ACCESS_LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+access_handler.setFormatter(logging.Formatter('%(message)s'))
+access_handler.addFilter(logging.Filter('access'))
+
+# Request threads only put records on a queue; a listener thread does the file I/O
+log_queue = queue.Queue()
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler, access_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Initialize logging with the queue in front of the file handlers
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+access_logger = logging.getLogger('access')
+
+LOG_LINE_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - (?:(DEBUG|INFO|WARNING|ERROR|CRITICAL) - )?(.*)$')
+
+def log_files():
+    """The current log and its rotated predecessors, newest first"""
+    paths = [LOG_FILE] + [f'{LOG_FILE}.{index}' for index in range(1, LOG_BACKUP_COUNT + 1)]
+    return [path for path in paths if os.path.exists(path)]
+
+def read_lines_backwards(f, end):
+    """Yield (line, start offset) from byte ``end`` towards the start of the file, one block at a time"""
+    position = end
+    tail = b''
+    while position > 0:
+        size = min(LOG_READ_BLOCK, position)
+        position -= size
+        f.seek(position)
+        lines = (f.read(size) + tail).split(b'\n')
+        # The first piece may be the end of a line that starts in an earlier block
+        tail = lines.pop(0)
+        offset = position + len(tail) + 1
+        starts = []
+        for line in lines:
+            starts.append(offset)
+            offset += len(line) + 1
+        for line, start in zip(reversed(lines), reversed(starts)):
+            yield line, start
+    if tail:
+        yield tail, 0
+
+def iter_log_entries(cursor=None):
+    """Log entries from newest to oldest across rotated files.
+
+    Yields (entry, cursor) where the cursor (``inode:offset``) points just
+    before the entry. Because it names the file by inode, a cursor stays
+    valid after the log rotates. Lines that do not start with a timestamp
+    (tracebacks) belong to the entry above them.
+    """
+    files = log_files()
+    start_index, end = 0, None
+    if cursor:
+        inode, _, offset = cursor.partition(':')
+        for index, path in enumerate(files):
+            if str(os.stat(path).st_ino) == inode:
+                start_index, end = index, int(offset)
+                break
+        else:
+            return    # Rotated out of existence
+    
+    for path in files[start_index:]:
+        with open(path, 'rb') as f:
+            inode = os.fstat(f.fileno()).st_ino
+            file_end = end if end is not None else os.fstat(f.fileno()).st_size
+            end = None
+            continuation = []
+            for line, offset in read_lines_backwards(f, file_end):
+                text = line.decode('utf-8', 'replace').rstrip('\r')
+                match = LOG_LINE_PATTERN.match(text)
+                if not match:
+                    if text:
+                        continuation.append(text)
+                    continue
+                timestamp, level, message = match.groups()
+                if continuation:
+                    message = '\n'.join([message] + continuation[::-1])
+                    continuation = []
+                yield {
+                    'timestamp': timestamp,
+                    'level': level or 'INFO',
+                    'message': message
+                }, f'{inode}:{offset}'
+
+def read_logs(limit=LOG_PAGE_SIZE, level=None, since=None, query=None, cursor=None):
+    """A page of log entries (oldest first) matching the filters, and the cursor of the next older page"""
+    minimum = logging.getLevelName(level.upper()) if level else 0
+    if not isinstance(minimum, int):
+        raise ValueError(f'未知的日志级别: {level}')
+    query = query.lower() if query else None
+    
+    entries = []
+    next_cursor = None
+    for entry, position in iter_log_entries(cursor):
+        if since and entry['timestamp'] < since:
+            # Everything further back is older still
+            next_cursor = None
+            break
+        if logging.getLevelName(entry['level']) < minimum:
+            continue
+        if query and query not in entry['message'].lower():
+            continue
+        if len(entries) == limit:
+            break
+        entries.append(entry)
+        next_cursor = position
+    else:
+        next_cursor = None
+    entries.reverse()
+    return entries, next_cursor
+
+# Per-thread timings of the request being handled (read by the access log)
+request_context = threading.local()
+
+@contextmanager
+def timed_db_access():
+    """Add the wall time spent inside the block to the current request's database time"""
+    depth = getattr(request_context, 'db_depth', 0)
+    request_context.db_depth = depth + 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        request_context.db_depth = depth
+        # Nested blocks (a pooled read around a queued write) are only counted once
+        if depth == 0:
+            request_context.db_time = getattr(request_context, 'db_time', 0.0) + time.perf_counter() - started
+
+class AccessLog:
+    """Sampled JSON-lines access log that can be switched on and off while running"""
+
+    def __init__(self, enabled=ACCESS_LOG_ENABLED, sample_rate=ACCESS_LOG_SAMPLE):
+        self.lock = threading.Lock()
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.stats = {'requests': 0, 'logged': 0}
+
+    def configure(self, enabled=None, sample_rate=None):
+        if sample_rate is not None and not 0 <= sample_rate <= 1:
+            raise ValueError('采样率必须在 0 到 1 之间')
+        with self.lock:
+            if enabled is not None:
+                self.enabled = enabled
+            if sample_rate is not None:
+                self.sample_rate = sample_rate
+        logging.info(f"Access log {'enabled' if self.enabled else 'disabled'}, sample rate {self.sample_rate}")
+
+    def record(self, entry):
+        with self.lock:
+            self.stats['requests'] += 1
+            if not self.enabled:
+                return
+            if entry['status'] < 500 and entry['totalMs'] < ACCESS_LOG_SLOW * 1000 \
+                    and random.random() >= self.sample_rate:
+                return
+            self.stats['logged'] += 1
+        access_logger.info(json.dumps(entry, ensure_ascii=False))
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, enabled=self.enabled, sampleRate=self.sample_rate)
+
+access_log = AccessLog()
+
+# Prometheus-style metrics (GET /metrics)
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_PRUNE_EVERY = 64     # Fold finished threads' shards away after this many new shards
+METRICS_JOB_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    Every thread updates its own shard without taking a lock; a scrape adds
+    the shards up. Shards of finished threads are folded into ``retired``
+    on each scrape and every METRICS_PRUNE_EVERY new shards, so
+    thread-per-connection servers do not pile them up.
+    Values that already live elsewhere (pool, cache, file sizes) come from
+    collectors called at scrape time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.shards = []
+        self.registered = 0
+        self.retired = {}
+        self.meta = OrderedDict()
+        self.collectors = []
+
+    def counter(self, name, help_text, labels=()):
+        self.meta[name] = ('counter', help_text, labels, None)
+
+    def gauge(self, name, help_text, labels=()):
+        self.meta[name] = ('gauge', help_text, labels, None)
+
+    def histogram(self, name, help_text, labels=(), buckets=METRICS_BUCKETS):
+        self.meta[name] = ('histogram', help_text, labels, buckets)
+
+    def collector(self, func):
+        """Register ``func()`` returning [(name, type, help, labels, [(label values, value)])]"""
+        self.collectors.append(func)
+        return func
+
+    def _shard(self):
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), values))
+                self.registered += 1
+                if self.registered % METRICS_PRUNE_EVERY == 0:
+                    self._retire_finished()
+            return values
+
+    def inc(self, name, labels=(), amount=1):
+        values = self._shard()
+        key = (name, labels)
+        values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        values = self._shard()
+        key = (name, labels)
+        counts = values.get(key)
+        if counts is None:
+            # One slot per bucket, one for +Inf, then the running sum
+            counts = values[key] = [0] * (len(self.meta[name][3]) + 2)
+        counts[bisect.bisect_left(self.meta[name][3], value)] += 1
+        counts[-1] += value
+
+    @staticmethod
+    def _add(total, values):
+        for key, value in values.items():
+            if isinstance(value, list):
+                current = total.get(key)
+                if current is None:
+                    total[key] = list(value)
+                else:
+                    for index, item in enumerate(value):
+                        current[index] += item
+            else:
+                total[key] = total.get(key, 0) + value
+
+    def _retire_finished(self):
+        # Called with the lock held; a finished thread no longer writes to its shard
+        alive = []
+        for thread, values in self.shards:
+            if thread.is_alive():
+                alive.append((thread, values))
+            else:
+                self._add(self.retired, values)
+        self.shards = alive
+
+    def snapshot(self):
+        totals = {}
+        with self.lock:
+            self._retire_finished()
+            alive = list(self.shards)
+            self._add(totals, self.retired)
+        for _, values in alive:
+            self._add(totals, values.copy())
+        return totals
+
+    def render(self):
+        totals = self.snapshot()
+        samples = {}
+        for (name, labels), value in totals.items():
+            samples.setdefault(name, []).append((labels, value))
+        
+        lines = []
+        for name, (kind, help_text, label_names, buckets) in self.meta.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(samples.get(name, ())):
+                if kind != 'histogram':
+                    lines.append(f'{name}{format_labels(label_names, labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(label_names + ("le",), labels + (bound,))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(label_names, labels)} {value[-1]}')
+                lines.append(f'{name}_count{format_labels(label_names, labels)} {cumulative}')
+        for collect in self.collectors:
+            try:
+                collected = collect()
+            except Exception as e:
+                logging.warning(f"Metrics collector {collect.__name__} failed: {str(e)}")
+                continue
+            for name, kind, help_text, label_names, values in collected:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in values:
+                    lines.append(f'{name}{format_labels(label_names, labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.counter('surgery_http_requests_total', 'HTTP requests by route, method and status', ('route', 'method', 'status'))
+metrics.histogram('surgery_http_request_duration_seconds', 'HTTP request latency by route', ('route',))
+metrics.gauge('surgery_http_requests_in_flight', 'Requests currently being handled')
+metrics.histogram('surgery_sql_duration_seconds', 'Time to execute a SQL statement, by statement kind and table', ('statement',))
+metrics.histogram('surgery_db_pool_wait_seconds', 'Time spent waiting for a pooled connection when none was free')
+metrics.histogram('surgery_job_duration_seconds', 'Duration of background maintenance jobs (backup, restore, archive, ...)',
+                  ('kind', 'status'), METRICS_JOB_BUCKETS)
+
+STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)', re.IGNORECASE)
+
+@functools.lru_cache(maxsize=512)
+def statement_label(sql):
+    """'SELECT Surgeries' style label, so the metric does not get one series per SQL text"""
+    words = sql.split(None, 1)
+    if not words:
+        return 'OTHER'
+    table = STATEMENT_TABLE.search(sql)
+    return f'{words[0].upper()} {table.group(1)}' if table else words[0].upper()
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.observe('surgery_sql_duration_seconds', (statement_label(sql),), time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.observe('surgery_sql_duration_seconds', (statement_label(sql),), time.perf_counter() - started)
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose statements are timed into surgery_sql_duration_seconds"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
 
-# Initialize logging with custom handler
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[UTF8FileHandler(LOG_FILE)]
-)
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# SQLite storage configuration (applied to every connection)
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_PRAGMAS = {
+    'synchronous': 'NORMAL',      # Safe with WAL, avoids an fsync per commit
+    'busy_timeout': 5000,         # Milliseconds to wait on a locked database
+    'cache_size': -16000,         # Negative means KiB (about 16 MB per connection)
+    'mmap_size': 64 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+# Single writer settings
+WRITER_BATCH_SIZE = 50      # Maximum number of queued writes grouped into one transaction
+WRITER_TIMEOUT = 30         # Seconds a request waits for its write to be committed
+
+def configure_connection(conn):
+    """Apply the storage PRAGMAs to a freshly opened connection"""
+    for name, value in SQLITE_PRAGMAS.items():
+        conn.execute(f'PRAGMA {name}={value}')
+    return conn
+
+# Shared connection pool settings
+DB_POOL_SIZE = 10           # Maximum number of open SQLite connections
+DB_POOL_TIMEOUT = 10        # Seconds to wait for a free connection
+DB_HEALTH_CHECK_IDLE = 60   # Re-validate connections idle longer than this (seconds)
+DB_POOL_DRAIN_TIMEOUT = 30  # Seconds paused() waits for checked-out connections to come back
 
 class DatabasePool:
-    def __init__(self, max_connections=10):
-        self.pool = queue.Queue(maxsize=max_connections)
-        for _ in range(max_connections):
-            conn = sqlite3.connect(DB_PATH)
-            self.pool.put(conn)
+    """Long-lived pool of SQLite connections shared by all request threads.
+
+    Connections are opened lazily up to ``max_connections`` and checked out
+    for the duration of a ``with pool.get_connection()`` block. Idle
+    connections are health checked before being handed out again, and
+    ``reset()`` retires every connection. ``paused()`` goes further for
+    replacing the database file: new checkouts wait until the block ends.
+    """
+
+    def __init__(self, db_path=DB_PATH, max_connections=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.db_path = db_path
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.pool = queue.LifoQueue(maxsize=max_connections)
+        self.lock = threading.Lock()
+        self.state_changed = threading.Condition(self.lock)
+        self.pause_depth = 0
+        self.created = 0
+        self.generation = 0
+        self.stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'active': 0,
+            'peak_active': 0,
+            'opened': 0,
+            'closed': 0,
+            'health_check_failures': 0,
+        }
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False,
+                               factory=TimedConnection)
+        configure_connection(conn)
+        with self.lock:
+            self.stats['opened'] += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self.lock:
+            self.created -= 1
+            self.stats['closed'] += 1
+
+    def _is_healthy(self, conn):
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            with self.lock:
+                self.stats['health_check_failures'] += 1
+            return False
+
+    def _acquire(self, timeout):
+        # Reuse an idle connection if there is one
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        # Otherwise open a new one if we are below the limit
+        with self.lock:
+            can_open = self.created < self.max_connections
+            if can_open:
+                self.created += 1
+        if can_open:
+            try:
+                return self._connect(), self.generation, time.monotonic()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+
+        # Pool exhausted: wait for a connection to be returned
+        started = time.monotonic()
+        try:
+            return self.pool.get(timeout=timeout)
+        except queue.Empty:
+            with self.lock:
+                self.stats['timeouts'] += 1
+            raise TimeoutError(f'No database connection available after {timeout} seconds')
+        finally:
+            waited = time.monotonic() - started
+            metrics.observe('surgery_db_pool_wait_seconds', (), waited)
+            with self.lock:
+                self.stats['waits'] += 1
+                self.stats['wait_time'] += waited
+
+    def _enter(self, timeout):
+        # Count the checkout as active before touching the database, waiting out a pause
+        deadline = time.monotonic() + timeout
+        with self.state_changed:
+            while self.pause_depth:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise TimeoutError(f'Database unavailable for {timeout} seconds')
+                self.state_changed.wait(remaining)
+            self.stats['active'] += 1
+            self.stats['peak_active'] = max(self.stats['peak_active'], self.stats['active'])
+
+    def _leave(self):
+        with self.state_changed:
+            self.stats['active'] -= 1
+            self.state_changed.notify_all()
+
+    @contextmanager
+    def get_connection(self, timeout=None):
+        with timed_db_access():
+            with self._checkout(timeout) as conn:
+                yield conn
 
     @contextmanager
-    def get_connection(self):
-        conn = self.pool.get()
+    def _checkout(self, timeout):
+        timeout = self.timeout if timeout is None else timeout
+        self._enter(timeout)
+        try:
+            while True:
+                conn, generation, last_used = self._acquire(timeout)
+                if generation != self.generation:
+                    self._close(conn)
+                    continue
+                if time.monotonic() - last_used > DB_HEALTH_CHECK_IDLE and not self._is_healthy(conn):
+                    self._close(conn)
+                    continue
+                break
+        except Exception:
+            self._leave()
+            raise
+
+        with self.lock:
+            self.stats['checkouts'] += 1
         try:
             yield conn
         finally:
-            self.pool.put(conn)
+            self._release(conn, generation)
+            self._leave()
+
+    def _release(self, conn, generation):
+        try:
+            # Never hand out a connection with a half-finished transaction
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._close(conn)
+            return
+        if generation != self.generation:
+            self._close(conn)
+            return
+        self.pool.put((conn, generation, time.monotonic()))
+
+    def reset(self):
+        """Close idle connections and retire the ones currently checked out"""
+        with self.lock:
+            self.generation += 1
+        while True:
+            try:
+                conn, _, _ = self.pool.get_nowait()
+            except queue.Empty:
+                break
+            self._close(conn)
+
+    @contextmanager
+    def paused(self, timeout=DB_POOL_DRAIN_TIMEOUT):
+        """Hold off new checkouts, wait for the current ones to finish and close every connection.
+
+        Requests arriving meanwhile wait (up to the pool timeout) and get a
+        fresh connection once the block exits, so swapping the database file
+        inside the block looks like a short pause to them, not an error.
+        Raises TimeoutError if connections are not returned within ``timeout``.
+        """
+        deadline = time.monotonic() + timeout
+        with self.state_changed:
+            self.pause_depth += 1
+            try:
+                while self.stats['active']:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f'{self.stats["active"]} database connections still in use')
+                    self.state_changed.wait(remaining)
+            except BaseException:
+                self.pause_depth -= 1
+                self.state_changed.notify_all()
+                raise
+        try:
+            self.reset()
+            yield
+        finally:
+            with self.state_changed:
+                self.pause_depth -= 1
+                self.state_changed.notify_all()
+
+    def close(self):
+        self.reset()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['open'] = self.created
+        stats['idle'] = self.pool.qsize()
+        stats['size'] = self.max_connections
+        stats['wait_time'] = round(stats['wait_time'], 3)
+        return stats
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Return the process-wide connection pool, creating it on first use"""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = DatabasePool()
+    return _db_pool
+
+class DatabaseWriter:
+    """Dedicated thread that performs every write to the database.
+
+    Callers submit a function taking the writer's connection; the thread
+    groups whatever is queued into a single transaction, running each job
+    inside its own savepoint so one failing job does not undo the others.
+    Results (or exceptions) are delivered once the transaction commits.
+    """
+
+    def __init__(self, db_path=DB_PATH, batch_size=WRITER_BATCH_SIZE):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.jobs = queue.Queue()
+        self.conn = None
+        self.thread = None
+        self.batch_lock = threading.Lock()
+        self.stats = {
+            'jobs': 0,
+            'batches': 0,
+            'failed_jobs': 0,
+            'failed_batches': 0,
+            'largest_batch': 0,
+        }
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout=5):
+        if self.thread is not None and self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join(timeout)
+        self.thread = None
+        self.close()
+
+    def close(self):
+        """Close the write connection; it is reopened on the next batch"""
+        with self.batch_lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def _connection(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False,
+                                        factory=TimedConnection)
+            configure_connection(self.conn)
+        return self.conn
+
+    def submit(self, func, *args):
+        """Queue ``func(conn, *args)`` and return a Future for its result"""
+        self.start()
+        future = Future()
+        self.jobs.put((future, func, args))
+        return future
+
+    def execute(self, func, *args, timeout=WRITER_TIMEOUT):
+        """Run ``func(conn, *args)`` on the writer thread and wait for the commit.
+
+        A write still queued after ``timeout`` is cancelled and TimeoutError
+        raised; one already running is waited for, since its batch will commit.
+        """
+        with timed_db_access():
+            future = self.submit(func, *args)
+            try:
+                return future.result(timeout)
+            except FutureTimeoutError:
+                if future.cancel():
+                    raise TimeoutError(f'Write not started within {timeout} seconds and was cancelled')
+                return future.result()
+
+    @contextmanager
+    def exclusive(self):
+        """Borrow the write connection outside of a transaction (VACUUM, ANALYZE)"""
+        with self.batch_lock:
+            yield self._connection()
+
+    @contextmanager
+    def paused(self):
+        """Hold off all writes and close the write connection (e.g. while replacing the file)"""
+        with self.batch_lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            yield
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            job = self.jobs.get()
+            if job is None:
+                break
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        outcomes = []
+        with self.batch_lock:
+            try:
+                conn = self._connection()
+                conn.execute('BEGIN IMMEDIATE')
+                for future, func, args in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    conn.execute('SAVEPOINT writer_job')
+                    try:
+                        result = func(conn, *args)
+                        conn.execute('RELEASE writer_job')
+                        outcomes.append((future, result, None))
+                    except Exception as e:
+                        conn.execute('ROLLBACK TO writer_job')
+                        conn.execute('RELEASE writer_job')
+                        outcomes.append((future, None, e))
+                conn.execute('COMMIT')
+                if (self.stats['batches'] + 1) % CHANGE_LOG_PRUNE_EVERY == 0:
+                    self._prune_change_log(conn)
+            except Exception as e:
+                logging.error(f"Write batch failed: {str(e)}")
+                self.stats['failed_batches'] += 1
+                try:
+                    if self.conn is not None and self.conn.in_transaction:
+                        self.conn.rollback()
+                except sqlite3.Error:
+                    # Close it so it cannot keep holding the write lock
+                    try:
+                        self.conn.close()
+                    except sqlite3.Error:
+                        pass
+                    self.conn = None
+                for future, _, _ in batch:
+                    if future.running() or (not future.done() and future.set_running_or_notify_cancel()):
+                        future.set_exception(e)
+                return
+
+        self.stats['batches'] += 1
+        self.stats['jobs'] += len(outcomes)
+        self.stats['largest_batch'] = max(self.stats['largest_batch'], len(outcomes))
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                self.stats['failed_jobs'] += 1
+                future.set_exception(error)
+
+    def _prune_change_log(self, conn):
+        # Keep SurgeryChanges bounded while the server runs, in its own small transaction
+        try:
+            prune_change_log(conn)
+        except sqlite3.Error as e:
+            logging.warning(f"Change log pruning failed: {str(e)}")
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['queued'] = self.jobs.qsize()
+        return stats
+
+_db_writer = None
+
+def get_db_writer():
+    """Return the process-wide writer, starting its thread on first use"""
+    global _db_writer
+    if _db_writer is None:
+        with _db_pool_lock:
+            if _db_writer is None:
+                _db_writer = DatabaseWriter()
+                _db_writer.start()
+    return _db_writer
+
+# Schema migrations, applied in order and recorded in PRAGMA user_version.
+# Each entry is (version, description, steps) where a step is either an SQL
+# statement or a function taking the connection.
+def seed_archived_count(conn):
+    """Starting value of the archived-rows counter: archive tables here plus rows moved to archive files"""
+    archived = 0
+    tables = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'SurgeryScheduleArchive%'").fetchall()
+    for (table,) in tables:
+        archived += conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+    archived += conn.execute("SELECT COALESCE(SUM(Moved), 0) FROM ArchiveProgress WHERE Mode='attached'").fetchone()[0]
+    conn.execute("INSERT OR REPLACE INTO TableCounts (Name, Count) VALUES ('archived', ?)", (archived,))
+
+MIGRATIONS = [
+    (1, 'Covering indexes for schedule lookups and date range scans', [
+        # Daily schedule: WHERE Department = ? AND Date = ? ORDER BY OperationOrder
+        # History/export:  WHERE Department = ? AND Date BETWEEN ? AND ?
+        'CREATE INDEX IF NOT EXISTS idx_surgery_dept_date_order ON SurgerySchedule(Department, Date, OperationOrder)',
+        # All-department export: WHERE Date BETWEEN ? AND ? ORDER BY Date, Department, OperationOrder
+        'CREATE INDEX IF NOT EXISTS idx_surgery_date_dept_order ON SurgerySchedule(Date, Department, OperationOrder)',
+        # Older manual indexes are prefixes of the ones above
+        'DROP INDEX IF EXISTS idx_surgery_date',
+        'DROP INDEX IF EXISTS idx_surgery_dept',
+        'DROP INDEX IF EXISTS idx_surgery_date_dept',
+    ]),
+    (2, 'Change log and per-day schedule versions', [
+        '''
+        CREATE TABLE IF NOT EXISTS SurgeryChanges (
+            Seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            Department TEXT NOT NULL,
+            Date TEXT NOT NULL,
+            SurgeryID INTEGER NOT NULL,
+            Operation TEXT NOT NULL,
+            ChangedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_changes_slice ON SurgeryChanges(Department, Date, Seq)',
+        '''
+        CREATE TABLE IF NOT EXISTS ScheduleVersions (
+            Department TEXT NOT NULL,
+            Date TEXT NOT NULL,
+            Version INTEGER NOT NULL,
+            PRIMARY KEY (Department, Date)
+        ) WITHOUT ROWID
+        ''',
+        # A record that moves to another day counts as a delete from the old slice
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_surgery_insert AFTER INSERT ON SurgerySchedule
+        BEGIN
+            INSERT INTO SurgeryChanges (Department, Date, SurgeryID, Operation)
+            VALUES (NEW.Department, NEW.Date, NEW.ID, 'insert');
+            INSERT OR REPLACE INTO ScheduleVersions (Department, Date, Version)
+            VALUES (NEW.Department, NEW.Date, (SELECT MAX(Seq) FROM SurgeryChanges));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_surgery_update AFTER UPDATE ON SurgerySchedule
+        BEGIN
+            INSERT INTO SurgeryChanges (Department, Date, SurgeryID, Operation)
+            SELECT OLD.Department, OLD.Date, OLD.ID, 'delete'
+            WHERE OLD.Department IS NOT NEW.Department OR OLD.Date IS NOT NEW.Date;
+            INSERT OR REPLACE INTO ScheduleVersions (Department, Date, Version)
+            SELECT OLD.Department, OLD.Date, (SELECT MAX(Seq) FROM SurgeryChanges)
+            WHERE OLD.Department IS NOT NEW.Department OR OLD.Date IS NOT NEW.Date;
+            INSERT INTO SurgeryChanges (Department, Date, SurgeryID, Operation)
+            VALUES (NEW.Department, NEW.Date, NEW.ID, 'update');
+            INSERT OR REPLACE INTO ScheduleVersions (Department, Date, Version)
+            VALUES (NEW.Department, NEW.Date, (SELECT MAX(Seq) FROM SurgeryChanges));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_surgery_delete AFTER DELETE ON SurgerySchedule
+        BEGIN
+            INSERT INTO SurgeryChanges (Department, Date, SurgeryID, Operation)
+            VALUES (OLD.Department, OLD.Date, OLD.ID, 'delete');
+            INSERT OR REPLACE INTO ScheduleVersions (Department, Date, Version)
+            VALUES (OLD.Department, OLD.Date, (SELECT MAX(Seq) FROM SurgeryChanges));
+        END
+        ''',
+    ]),
+    (3, 'Row version for optimistic concurrency', [
+        'ALTER TABLE SurgerySchedule ADD COLUMN Version INTEGER NOT NULL DEFAULT 1',
+    ]),
+    # Incremental backups are only valid against a snapshot of the same database instance
+    (4, 'Database instance id for backup chains', [
+        'CREATE TABLE IF NOT EXISTS DatabaseInfo (Key TEXT PRIMARY KEY, Value TEXT NOT NULL) WITHOUT ROWID',
+        "INSERT OR IGNORE INTO DatabaseInfo (Key, Value) VALUES ('instance', lower(hex(randomblob(8))))",
+    ]),
+    (5, 'Checkpoints for the batched archive job', [
+        '''
+        CREATE TABLE IF NOT EXISTS ArchiveProgress (
+            ID INTEGER PRIMARY KEY AUTOINCREMENT,
+            Cutoff TEXT NOT NULL,
+            Mode TEXT NOT NULL,
+            LastID INTEGER NOT NULL,
+            MaxID INTEGER NOT NULL,
+            Moved INTEGER NOT NULL DEFAULT 0,
+            Status TEXT NOT NULL,
+            StartedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UpdatedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    # Kept current by triggers (and by the archive job) so statistics never scan the schedule
+    (6, 'Summary tables for statistics', [
+        'CREATE TABLE IF NOT EXISTS TableCounts (Name TEXT PRIMARY KEY, Count INTEGER NOT NULL) WITHOUT ROWID',
+        '''
+        CREATE TABLE IF NOT EXISTS DepartmentCounts (
+            Department TEXT PRIMARY KEY,
+            Count INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        # Keyed by date first, so MIN(Date) / MAX(Date) are single index lookups
+        '''
+        CREATE TABLE IF NOT EXISTS DailyCounts (
+            Date TEXT NOT NULL,
+            Department TEXT NOT NULL,
+            Count INTEGER NOT NULL,
+            PRIMARY KEY (Date, Department)
+        ) WITHOUT ROWID
+        ''',
+        "INSERT OR REPLACE INTO TableCounts (Name, Count) SELECT 'SurgerySchedule', COUNT(*) FROM SurgerySchedule",
+        'INSERT OR REPLACE INTO DepartmentCounts SELECT Department, COUNT(*) FROM SurgerySchedule GROUP BY Department',
+        'INSERT OR REPLACE INTO DailyCounts SELECT Date, Department, COUNT(*) FROM SurgerySchedule GROUP BY Date, Department',
+        seed_archived_count,
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_insert AFTER INSERT ON SurgerySchedule
+        BEGIN
+            UPDATE TableCounts SET Count = Count + 1 WHERE Name = 'SurgerySchedule';
+            INSERT INTO DepartmentCounts (Department, Count) VALUES (NEW.Department, 1)
+            ON CONFLICT (Department) DO UPDATE SET Count = Count + 1;
+            INSERT INTO DailyCounts (Date, Department, Count) VALUES (NEW.Date, NEW.Department, 1)
+            ON CONFLICT (Date, Department) DO UPDATE SET Count = Count + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_delete AFTER DELETE ON SurgerySchedule
+        BEGIN
+            UPDATE TableCounts SET Count = Count - 1 WHERE Name = 'SurgerySchedule';
+            UPDATE DepartmentCounts SET Count = Count - 1 WHERE Department = OLD.Department;
+            DELETE FROM DepartmentCounts WHERE Department = OLD.Department AND Count <= 0;
+            UPDATE DailyCounts SET Count = Count - 1 WHERE Date = OLD.Date AND Department = OLD.Department;
+            DELETE FROM DailyCounts WHERE Date = OLD.Date AND Department = OLD.Department AND Count <= 0;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_update AFTER UPDATE OF Date, Department ON SurgerySchedule
+        WHEN OLD.Date IS NOT NEW.Date OR OLD.Department IS NOT NEW.Department
+        BEGIN
+            UPDATE DepartmentCounts SET Count = Count - 1 WHERE Department = OLD.Department;
+            DELETE FROM DepartmentCounts WHERE Department = OLD.Department AND Count <= 0;
+            UPDATE DailyCounts SET Count = Count - 1 WHERE Date = OLD.Date AND Department = OLD.Department;
+            DELETE FROM DailyCounts WHERE Date = OLD.Date AND Department = OLD.Department AND Count <= 0;
+            INSERT INTO DepartmentCounts (Department, Count) VALUES (NEW.Department, 1)
+            ON CONFLICT (Department) DO UPDATE SET Count = Count + 1;
+            INSERT INTO DailyCounts (Date, Department, Count) VALUES (NEW.Date, NEW.Department, 1)
+            ON CONFLICT (Date, Department) DO UPDATE SET Count = Count + 1;
+        END
+        ''',
+    ]),
+]
+
+# Change log entries kept for delta sync (older clients get a full reload)
+CHANGE_LOG_MAX_ROWS = 100000
+CHANGE_LOG_PRUNE_EVERY = 100    # Writer batches between change-log trims
+
+def prune_change_log(conn):
+    """Keep the newest CHANGE_LOG_MAX_ROWS entries (at startup, every few writer batches, after archiving)"""
+    conn.execute('''
+        DELETE FROM SurgeryChanges
+        WHERE Seq <= (SELECT MAX(Seq) FROM SurgeryChanges) - ?
+    ''', (CHANGE_LOG_MAX_ROWS,))
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def run_migrations(conn):
+    """Bring the schema up to date; ``conn`` must be in autocommit mode.
+
+    Each migration runs in its own transaction together with the
+    user_version bump. Statistics are refreshed with ANALYZE after any
+    migration was applied, otherwise ``PRAGMA optimize`` decides.
+    """
+    current = get_schema_version(conn)
+    applied = []
+    for version, description, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f'PRAGMA user_version={version}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            logging.error(f"Schema migration {version} failed: {description}")
+            raise
+        logging.info(f"Applied schema migration {version}: {description}")
+        applied.append(version)
+
+    if applied:
+        conn.execute('ANALYZE')
+    else:
+        conn.execute('PRAGMA optimize')
+    return get_schema_version(conn)
 
 def init_db():
     """Initialize the surgery scheduling database"""
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
+    # WAL lets readers keep working while a write is in progress
+    cursor.execute(f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE}')
+    
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS SurgerySchedule (
             ID INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -97,101 +1115,1693 @@ def init_db():
     ''')
     
     conn.commit()
+    
+    conn.isolation_level = None
+    run_migrations(conn)
+    prune_change_log(conn)
     conn.close()
 
+# Template cache settings
+TEMPLATE_DEV_MODE = False   # Recompile templates on every request while editing them
+
+# Response compression
+COMPRESSION_MIN_SIZE = 1024     # Bodies smaller than this are sent as-is
+COMPRESSION_LEVEL = 6
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/x-ndjson', 'application/javascript', 'image/svg+xml')
+
+# Streaming exports
+EXPORT_BATCH_SIZE = 500     # Rows fetched from SQLite per chunk
+
+# HTTP caching
+TEMPLATE_CACHE_CONTROL = 'private, no-cache'   # Pages are revalidated with their ETag
+STATIC_MAX_AGE = 3600                          # Seconds browsers may reuse /static/ files
+
+INCLUDE_PATTERN = re.compile(r'{{\s*include\s+[\'"](.*?)[\'\"]\s*}}')
+VARIABLE_PATTERN = re.compile(r'{{(\w+)}}')
+
+def make_etag(body):
+    """Strong validator for a response body"""
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+def is_compressible(content_type):
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+def compress_body(body, encoding):
+    """Encode a body for the given Content-Encoding (gzip or deflate)"""
+    if encoding == 'gzip':
+        return gzip.compress(body, COMPRESSION_LEVEL, mtime=0)
+    if encoding == 'deflate':
+        return zlib.compress(body, COMPRESSION_LEVEL)
+    return body
+
+class ChunkedWriter:
+    """Response body written incrementally with Transfer-Encoding: chunked.
+
+    When an encoding is given the data is compressed on the fly; ``flush()``
+    pushes whatever the compressor holds so the client sees it right away.
+    """
+
+    def __init__(self, wfile, encoding=None, chunked=True):
+        self.wfile = wfile
+        self.chunked = chunked
+        self.compressor = None
+        if encoding:
+            wbits = 31 if encoding == 'gzip' else 15
+            self.compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, wbits)
+        self.bytes_sent = 0
+
+    def _send(self, data):
+        if not data:
+            return
+        self.bytes_sent += len(data)
+        if self.chunked:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def write(self, data):
+        size = len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self._send(data)
+        return size
+
+    def flush(self):
+        if self.compressor is not None:
+            self._send(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.wfile.flush()
+
+    def close(self):
+        if self.compressor is not None:
+            self._send(self.compressor.flush())
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+class CachedBody:
+    """A cacheable response body with its validators and compressed variants"""
+
+    def __init__(self, body, mtime, content_type):
+        self.body = body
+        self.mtime = mtime
+        self.content_type = content_type
+        self.etag = make_etag(body)
+        self.variants = {}
+
+    def encoded(self, encoding):
+        """Return (body, etag) for a Content-Encoding, compressing at most once"""
+        if not encoding:
+            return self.body, self.etag
+        variant = self.variants.get(encoding)
+        if variant is None:
+            variant = (compress_body(self.body, encoding), self.etag[:-1] + '-' + encoding + '"')
+            self.variants[encoding] = variant
+        return variant
+
+class CompiledTemplate(CachedBody):
+    """A template with its includes resolved and its variables pre-split.
+
+    ``segments`` alternates literal text and variable names, ``body`` holds
+    the UTF-8 bytes ready to send when no variables are substituted, and
+    ``files`` maps every file the template was built from to its mtime.
+    """
+
+    def __init__(self, name, content, files):
+        super().__init__(content.encode('utf-8'), max(files.values()) / 1e9,
+                         'text/html; charset=utf-8')
+        self.name = name
+        self.files = files
+        self.segments = VARIABLE_PATTERN.split(content)
+
+    def render(self, **kwargs):
+        if not kwargs:
+            return self.body.decode('utf-8')
+        parts = []
+        for i, segment in enumerate(self.segments):
+            if i % 2 == 0:
+                parts.append(segment)
+            elif segment in kwargs:
+                parts.append(str(kwargs[segment]))
+            else:
+                # Unknown variables are left as they were
+                parts.append('{{' + segment + '}}')
+        return ''.join(parts)
+
+    def is_stale(self):
+        for path, mtime in self.files.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+class TemplateCache:
+    """Compiled templates keyed by file name, invalidated when a source file changes"""
+
+    def __init__(self, template_dir=TEMPLATE_DIR):
+        self.template_dir = template_dir
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def get(self, filename):
+        template = self.templates.get(filename)
+        if template is None or TEMPLATE_DEV_MODE or template.is_stale():
+            template = self._compile(filename)
+            with self.lock:
+                self.templates[filename] = template
+        return template
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+
+    def _read(self, filename, files):
+        path = os.path.join(self.template_dir, filename)
+        files[path] = os.stat(path).st_mtime_ns
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def _compile(self, filename):
+        files = {}
+        content = self._read(filename, files)
+        
+        # Handle includes
+        content = INCLUDE_PATTERN.sub(lambda match: self._read(match.group(1), files), content)
+        
+        return CompiledTemplate(filename, content, files)
+
+template_cache = TemplateCache()
+
+class StaticFile(CachedBody):
+    """Contents and validators of one file under STATIC_DIR"""
+
+    def __init__(self, path, body, mtime_ns, content_type):
+        super().__init__(body, mtime_ns / 1e9, content_type)
+        self.path = path
+        self.mtime_ns = mtime_ns
+
+    def is_stale(self):
+        try:
+            return os.stat(self.path).st_mtime_ns != self.mtime_ns
+        except OSError:
+            return True
+
+class StaticFileCache:
+    """Static files kept in memory and re-read when their mtime changes"""
+
+    def __init__(self, root=STATIC_DIR):
+        self.root = os.path.realpath(root)
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, relative_path):
+        path = os.path.realpath(os.path.join(self.root, relative_path.lstrip('/')))
+        if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+            raise FileNotFoundError(relative_path)
+        return path
+
+    def get(self, relative_path):
+        path = self.resolve(relative_path)
+        entry = self.files.get(path)
+        if entry is None or entry.is_stale():
+            mtime_ns = os.stat(path).st_mtime_ns
+            with open(path, 'rb') as f:
+                body = f.read()
+            content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            if content_type.startswith('text/') or content_type == 'application/javascript':
+                content_type += '; charset=utf-8'
+            entry = StaticFile(path, body, mtime_ns, content_type)
+            with self.lock:
+                self.files[path] = entry
+        return entry
+
+static_cache = StaticFileCache()
+
+# Schedule response cache
+SCHEDULE_CACHE_SIZE = 512   # (date, department) responses kept in memory
+
+class ScheduleCache:
+    """LRU cache of serialized /api/surgeries responses keyed by (date, department).
+
+    Write handlers invalidate the slices they touch. A reader records the
+    invalidation epoch before querying and ``put()`` drops its result if an
+    invalidation happened meanwhile, so a slow read cannot resurrect
+    stale data.
+    """
+
+    def __init__(self, max_entries=SCHEDULE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.epoch = 0
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None, self.epoch
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry, self.epoch
+
+    def put(self, key, entry, epoch):
+        with self.lock:
+            if epoch != self.epoch:
+                return
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, *keys):
+        with self.lock:
+            self.epoch += 1
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.stats['invalidations'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.stats['invalidations'] += len(self.entries)
+            self.entries.clear()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
+
+schedule_cache = ScheduleCache()
+
+# Server-Sent Events
+SSE_HEARTBEAT = 15          # Seconds between keep-alive comments on an idle stream
+SSE_CLIENT_QUEUE = 100      # Events buffered per client before it is told to reload
+SSE_HISTORY = 1000          # Recent events kept for Last-Event-ID resume
+SSE_MAX_THREAD_CLIENTS = SERVER_WORKERS // 2   # Streams allowed to hold a worker thread
+SSE_MAX_ASYNC_CLIENTS = 1000                   # Streams served on the asyncio loop
+
+def format_sse(event_id, event_type, data):
+    return f'id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+
+class EventSubscription:
+    """One connected client: a bounded queue plus an optional department filter"""
+
+    def __init__(self, departments=None, notify=None):
+        self.events = queue.Queue(maxsize=SSE_CLIENT_QUEUE)
+        self.departments = set(departments) if departments else None
+        self.notify = notify
+        self.overflowed = False
+
+    def offer(self, event):
+        event_id, event_type, data = event
+        if self.departments and data.get('department') not in self.departments and event_type != 'reset':
+            return
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            # A client this far behind reloads instead of replaying
+            self.overflowed = True
+        if self.notify is not None:
+            self.notify()
+
+class EventBroker:
+    """Fans schedule changes out to SSE clients, keeping a short history for resume"""
+
+    def __init__(self, history_size=SSE_HISTORY):
+        self.lock = threading.Lock()
+        self.history = deque(maxlen=history_size)
+        self.subscribers = set()
+        self.boot = int(time.time())
+        self.counter = 0
+        self.stats = {'published': 0, 'overflows': 0}
+
+    def publish(self, event_type, data):
+        with self.lock:
+            self.counter += 1
+            event = (f'{self.boot}:{self.counter}', event_type, data)
+            self.history.append(event)
+            self.stats['published'] += 1
+            subscribers = list(self.subscribers)
+        for subscription in subscribers:
+            subscription.offer(event)
+
+    def publish_change(self, event_type, slices, surgery_id=None):
+        """Publish one event per affected (date, department) slice"""
+        for date, department in dict.fromkeys(slices):
+            self.publish(event_type, {'department': department, 'date': date, 'id': surgery_id})
+
+    def subscribe(self, last_event_id=None, departments=None, notify=None, limit=None):
+        """Register a client; returns None when ``limit`` clients are already connected.
+
+        Events after ``last_event_id`` are queued for replay. If that id is
+        from an earlier server run or has fallen out of the history, a
+        ``reset`` event tells the client to reload instead.
+        """
+        subscription = EventSubscription(departments, notify)
+        with self.lock:
+            if limit is not None and len(self.subscribers) >= limit:
+                return None
+            if last_event_id:
+                boot, _, number = last_event_id.partition(':')
+                oldest = int(self.history[0][0].split(':')[1]) if self.history else self.counter + 1
+                if boot != str(self.boot) or not number.isdigit() or int(number) < oldest - 1:
+                    subscription.offer((f'{self.boot}:{self.counter}', 'reset', {}))
+                else:
+                    for event in self.history:
+                        if int(event[0].split(':')[1]) > int(number):
+                            subscription.offer(event)
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+            if subscription.overflowed:
+                self.stats['overflows'] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['clients'] = len(self.subscribers)
+        return stats
+
+event_broker = EventBroker()
+
 def load_template(filename, **kwargs):
     """Load a template and replace any includes"""
-    with open(os.path.join(TEMPLATE_DIR, filename), 'r', encoding='utf-8') as f:
-        content = f.read()
-        
-    # Handle includes
-    include_pattern = r'{{\s*include\s+[\'"](.*?)[\'\"]\s*}}'
-    matches = re.finditer(include_pattern, content)
+    return template_cache.get(filename).render(**kwargs)
+
+def schedule_title(date, department):
+    # Set title based on department
+    title = "颌面外科手术安排表" if department == '手术麻醉科' else f'{department}手术安排表'
+    return f'{title} {date}'
+
+def get_schedule_version(cursor, date, department):
+    """Version token of a (date, department) slice: '<database instance>.<change sequence>'.
+
+    The change sequence starts over after a reset, restore or import; the
+    instance id, which is new each time, keeps the tokens of different
+    databases apart.
+    """
+    instance = cursor.execute("SELECT Value FROM DatabaseInfo WHERE Key='instance'").fetchone()
+    row = cursor.execute('SELECT Version FROM ScheduleVersions WHERE Department = ? AND Date = ?',
+                         (department, date)).fetchone()
+    return f'{instance[0] if instance else ""}.{row[0] if row else 0}'
+
+def parse_schedule_version(token, current):
+    """Change sequence of ``token`` if it belongs to the same database as ``current``, else None"""
+    instance, _, seq = token.rpartition('.')
+    if instance != current.rpartition('.')[0] or not seq.isdigit():
+        return None
+    return int(seq)
+
+# Batch schedule endpoint
+BATCH_MAX_DATES = 62        # Explicit dates accepted by /api/surgeries/batch in one call
+
+def split_param(params, name):
+    """Values of a query parameter given repeatedly and/or comma separated"""
+    values = []
+    for value in params.get(name, []):
+        values.extend(item.strip() for item in value.split(',') if item.strip())
+    return list(dict.fromkeys(values))
+
+# Columns of an export and their headers in the exported file
+EXPORT_COLUMNS = ['Date', 'Department', 'BedNumber', 'PatientName', 'Gender', 'Age',
+                  'HospitalNumber', 'Diagnosis', 'Operation', 'MainSurgeon',
+                  'Assistant', 'AnesthesiaDoctor', 'AnesthesiaType', 'PreOpPrep',
+                  'OperationOrder']
+EXPORT_HEADERS = ['日期', '病区', '床号', '姓名', '性别', '年龄',
+                  '住院号', '临床诊断', '术式', '主刀',
+                  '助手', '管床医师', '麻醉', '术前准备', '台次']
+
+def write_csv_export(cursor, body):
+    """Write cursor rows as CSV, batch by batch so memory stays flat for any date range"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    encoder = codecs.getincrementalencoder('utf-8-sig')()
+    writer.writerow(EXPORT_HEADERS)
+    while True:
+        body.write(encoder.encode(output.getvalue()))
+        body.flush()
+        output.seek(0)
+        output.truncate()
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            break
+        writer.writerows(rows)
+
+def write_ndjson_export(cursor, body):
+    """Write one JSON object per row, keyed by column name"""
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            break
+        lines = [json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + '\n' for row in rows]
+        body.write(''.join(lines).encode('utf-8'))
+        body.flush()
+
+# Characters that are not allowed in XML 1.0 documents
+XML_INVALID_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+XLSX_STATIC_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="手术安排" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+        'Target="styles.xml"/>'
+        '</Relationships>'),
+    'xl/styles.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+        '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="1"><fill><patternFill patternType="none"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'),
+}
+
+def xlsx_column(index):
+    """Spreadsheet column letters for a zero-based index (0 -> A, 26 -> AA)"""
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+def xlsx_row(number, values, style=0):
+    cells = []
+    for i, value in enumerate(values):
+        ref = f'{xlsx_column(i)}{number}'
+        style_attr = f' s="{style}"' if style else ''
+        if value is None or value == '':
+            continue
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c r="{ref}"{style_attr}><v>{value}</v></c>')
+        else:
+            text = xml_escape(XML_INVALID_CHARS.sub('', str(value)))
+            cells.append(f'<c r="{ref}"{style_attr} t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+    return f'<row r="{number}">' + ''.join(cells) + '</row>'
+
+def write_xlsx_export(cursor, body):
+    """Write an .xlsx workbook, streaming the sheet rows into the zip as they are fetched"""
+    with zipfile.ZipFile(body, 'w', zipfile.ZIP_DEFLATED) as workbook:
+        for name, content in XLSX_STATIC_PARTS.items():
+            workbook.writestr(name, content)
+        with workbook.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                b'<sheetData>')
+            sheet.write(xlsx_row(1, EXPORT_HEADERS, style=1).encode('utf-8'))
+            number = 1
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                chunk = []
+                for row in rows:
+                    number += 1
+                    chunk.append(xlsx_row(number, row))
+                sheet.write(''.join(chunk).encode('utf-8'))
+                body.flush()
+            sheet.write(b'</sheetData></worksheet>')
+
+# Export formats: ?format=<name> -> (Content-Type, writer)
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', write_csv_export),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', write_xlsx_export),
+    'ndjson': ('application/x-ndjson; charset=utf-8', write_ndjson_export),
+}
+
+# Online backups
+BACKUP_PAGES_PER_STEP = 256     # Pages copied per backup step
+BACKUP_STEP_PAUSE = 0.005       # Seconds to yield between steps
+BACKUP_ZIP_CHUNK = 1024 * 1024  # Bytes handed to the compressor at a time
+BACKUP_MEMORY_MAX = 64 * 1024 * 1024  # Larger databases are snapshotted to a temp file, not RAM
+MAINTENANCE_JOBS_KEPT = 20      # Finished jobs still reported by /api/database/backups
+BACKUP_MANIFEST = 'manifest.json'
+
+def copy_database(dest, progress=None):
+    """Copy the live database into the connection ``dest`` with the SQLite backup API.
+
+    The copy is a consistent snapshot even while requests keep writing.
+    Pages move in small steps, so other connections are never locked out
+    for long. ``progress`` is called with the fraction copied so far.
+    """
+    source = configure_connection(sqlite3.connect(DB_PATH))
+
+    def step(status, remaining, total):
+        if progress is not None and total:
+            progress((total - remaining) / total)
+        time.sleep(BACKUP_STEP_PAUSE)
+
+    try:
+        source.backup(dest, pages=BACKUP_PAGES_PER_STEP, progress=step)
+    finally:
+        source.close()
+
+def snapshot_position(conn):
+    """(instance id, last change-log sequence) of a database, for backup chains"""
+    instance = conn.execute("SELECT Value FROM DatabaseInfo WHERE Key='instance'").fetchone()
+    seq = conn.execute('SELECT MAX(Seq) FROM SurgeryChanges').fetchone()[0]
+    return instance[0] if instance else None, seq or 0
+
+def archived_count(conn):
+    """Records moved out by archive runs so far (TableCounts keeps the running total)"""
+    row = conn.execute("SELECT Count FROM TableCounts WHERE Name='archived'").fetchone()
+    return row[0] if row else 0
+
+def backup_manifest(backup_type, conn, **extra):
+    instance, seq = snapshot_position(conn)
+    now = time.time()
+    manifest = {
+        'type': backup_type,
+        'instance': instance,
+        'seq': seq,
+        'archived': archived_count(conn),
+        'timestamp': now,
+        'created': datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S'),
+        'schemaVersion': get_schema_version(conn),
+    }
+    manifest.update(extra)
+    return json.dumps(manifest).encode('utf-8')
+
+def write_backup_zip(zip_path, job=None):
+    """Back up the live database straight into a zip archive.
+
+    Databases up to BACKUP_MEMORY_MAX are snapshotted into memory and
+    compressed from there, so no uncompressed copy touches the disk
+    (Python 3.11+). Serializing briefly needs a second copy, so the peak
+    is about twice the database size. Larger databases, and older Pythons,
+    go through a temporary file instead. The archive only appears under
+    its final name once it is complete, with a manifest recording the
+    change-log position it can serve as the base of incremental backups.
+    """
+    member = os.path.basename(zip_path)[:-len('.zip')]
+    partial = zip_path + '.part'
+    temp_path = partial + '.db'
+    size = sum(os.path.getsize(path) for path in (DB_PATH, DB_PATH + '-wal') if os.path.exists(path))
+    in_memory = hasattr(sqlite3.Connection, 'serialize') and size <= BACKUP_MEMORY_MAX
+
+    def report(fraction):
+        if job is not None:
+            job.progress = int(fraction * 90)
+
+    try:
+        with zipfile.ZipFile(partial, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            snapshot = sqlite3.connect(':memory:' if in_memory else temp_path)
+            try:
+                copy_database(snapshot, report)
+                zipf.writestr(BACKUP_MANIFEST, backup_manifest('full', snapshot))
+                if in_memory:
+                    data = memoryview(snapshot.serialize())
+                    # Only keep the serialized copy while compressing
+                    snapshot.close()
+            finally:
+                snapshot.close()
+            if in_memory:
+                with zipf.open(member, 'w', force_zip64=len(data) > zipfile.ZIP64_LIMIT) as out:
+                    for offset in range(0, len(data), BACKUP_ZIP_CHUNK):
+                        out.write(data[offset:offset + BACKUP_ZIP_CHUNK])
+                        report(1 + offset / len(data) / 9)
+            else:
+                zipf.write(temp_path, member)
+        os.replace(partial, zip_path)
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return os.path.basename(zip_path)
+
+class MaintenanceJob:
+    """Progress of one background job (backup, restore, archive), as reported to the maintenance page"""
+
+    def __init__(self, job_id, kind):
+        self.id = job_id
+        self.kind = kind
+        self.status = 'pending'
+        self.progress = 0
+        self.filename = None
+        self.message = None
+        self.started = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'filename': self.filename,
+            'message': self.message,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+class MaintenanceJobs:
+    """Runs maintenance jobs one at a time on a background thread, so they never overlap"""
+
+    def __init__(self, keep=MAINTENANCE_JOBS_KEPT):
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.keep = keep
+        self.counter = 0
+        self.executor = None
+
+    def submit(self, kind, func, failure_message):
+        """Queue ``func(job)``; its exceptions become ``failure_message: error``"""
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='maintenance')
+            self.counter += 1
+            job = MaintenanceJob(self.counter, kind)
+            self.jobs[job.id] = job
+            for old_id in [job_id for job_id, old in self.jobs.items() if old.finished][:-self.keep or None]:
+                del self.jobs[old_id]
+        self.executor.submit(self._run, job, func, failure_message)
+        return job
+
+    def _run(self, job, func, failure_message):
+        job.status = 'running'
+        started = time.perf_counter()
+        try:
+            func(job)
+            job.progress = 100
+            job.status = 'done'
+        except Exception as e:
+            logging.error(f"{failure_message}: {str(e)}")
+            job.message = f'{failure_message}: {str(e)}'
+            job.status = 'failed'
+        job.finished = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        metrics.observe('surgery_job_duration_seconds', (job.kind, job.status), time.perf_counter() - started)
+
+    def list(self):
+        with self.lock:
+            return [job.to_dict() for job in reversed(self.jobs.values())]
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+maintenance_jobs = MaintenanceJobs()
+
+# Scheduled backups: periodic full snapshots with incremental backups in between
+BACKUP_SCHEDULE_ENABLED = True
+BACKUP_SCHEDULE_CHECK = 60              # Seconds between scheduler checks
+BACKUP_FULL_INTERVAL = 24 * 3600        # Seconds between automatic full snapshots
+BACKUP_INCREMENTAL_INTERVAL = 3600      # Seconds between incremental backups
+BACKUP_KEEP_HOURLY = 48                 # Retention: newest incremental per hour, for this many hours
+BACKUP_KEEP_DAILY = 7                   # Retention: newest automatic snapshot per day
+BACKUP_KEEP_WEEKLY = 4                  # Retention: newest automatic snapshot per ISO week
+BACKUP_AUTO_PREFIX = 'auto_'            # Only automatic backups are subject to retention
+
+def read_backup_manifest(filename):
+    """Describe one backup archive; archives from before manifests count as full snapshots"""
+    path = os.path.join(BACKUP_DIR, filename)
+    stat = os.stat(path)
+    info = {
+        'type': 'full',
+        'seq': None,
+        'instance': None,
+        'timestamp': stat.st_mtime,
+        'created': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    try:
+        with zipfile.ZipFile(path) as zipf:
+            if BACKUP_MANIFEST in zipf.namelist():
+                info.update(json.loads(zipf.read(BACKUP_MANIFEST)))
+    except (zipfile.BadZipFile, ValueError):
+        info['type'] = 'invalid'
+    info['filename'] = filename
+    info['bytes'] = stat.st_size
+    info['size'] = f'{round(stat.st_size / (1024 * 1024), 2)} MB'
+    info['automatic'] = filename.startswith(BACKUP_AUTO_PREFIX)
+    return info
+
+def list_backups():
+    """All backup archives, newest first"""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    backups = []
+    for filename in os.listdir(BACKUP_DIR):
+        if filename.endswith('.zip'):
+            try:
+                backups.append(read_backup_manifest(filename))
+            except OSError:
+                continue    # Removed while listing
+    return sorted(backups, key=lambda backup: backup['timestamp'], reverse=True)
+
+def latest_base_snapshot(backups):
+    """Newest full snapshot that incremental backups can be taken against"""
+    for backup in backups:
+        if backup['type'] == 'full' and backup['seq'] is not None:
+            return backup
+    return None
+
+def write_changes_zip(conn, path, base):
+    """Write the manifest and the current state of every row changed after ``base``"""
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        zipf.writestr(BACKUP_MANIFEST, backup_manifest(
+            'incremental', conn, base=base['filename'], baseSeq=base['seq']))
+        with zipf.open('changes.ndjson', 'w') as out:
+            cursor = conn.execute('''
+                SELECT c.SurgeryID, s.*
+                FROM (SELECT DISTINCT SurgeryID FROM SurgeryChanges WHERE Seq > ?) c
+                LEFT JOIN SurgerySchedule s ON s.ID = c.SurgeryID
+            ''', (base['seq'],))
+            columns = [description[0] for description in cursor.description][1:]
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                lines = []
+                for row in rows:
+                    if row[1] is None:
+                        change = {'op': 'delete', 'ID': row[0]}
+                    else:
+                        change = {'op': 'upsert', 'row': dict(zip(columns, row[1:]))}
+                    lines.append(json.dumps(change, ensure_ascii=False) + '\n')
+                out.write(''.join(lines).encode('utf-8'))
+
+def write_incremental_backup(zip_path, base):
+    """Record the rows changed since the snapshot ``base`` (a manifest) in a zip.
+
+    Each incremental backup holds every change since its base, not since
+    the previous incremental, so restoring needs only the base and one
+    incremental, and retention may drop any of them independently.
+    Returns None when a new full snapshot is needed instead: the database
+    was reset or restored since the base, the change log no longer
+    reaches back that far, or an archive run has moved records since (the
+    change log only shows those as deletes, so the archived copies would
+    be missing from a restore).
+    """
+    with get_db_pool().get_connection() as conn:
+        # One read transaction: the change list and the row contents agree
+        conn.execute('BEGIN')
+        try:
+            instance, seq = snapshot_position(conn)
+            oldest = conn.execute('SELECT MIN(Seq) FROM SurgeryChanges').fetchone()[0]
+            if instance != base['instance'] or seq < base['seq'] or (oldest or 0) > base['seq'] + 1:
+                return None
+            if archived_count(conn) != base.get('archived'):
+                return None
+            
+            partial = zip_path + '.part'
+            try:
+                write_changes_zip(conn, partial, base)
+            except Exception:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+            os.replace(partial, zip_path)
+        finally:
+            conn.commit()
+    return os.path.basename(zip_path)
+
+def apply_backup_retention():
+    """Delete automatic backups the retention policy no longer keeps.
+
+    Full snapshots: the newest of each of the last BACKUP_KEEP_DAILY days and
+    BACKUP_KEEP_WEEKLY weeks. Incremental backups: the newest of each of the
+    last BACKUP_KEEP_HOURLY hours, as long as their base is still kept.
+    Backups taken by hand are never removed.
+    """
+    backups = list_backups()
+    days, weeks, hours = {}, {}, {}
+    for backup in backups:
+        if not backup['automatic'] or backup['type'] != 'full':
+            continue
+        taken = datetime.fromtimestamp(backup['timestamp'])
+        if len(days) < BACKUP_KEEP_DAILY:
+            days.setdefault(taken.date(), backup['filename'])
+        if len(weeks) < BACKUP_KEEP_WEEKLY:
+            weeks.setdefault(taken.isocalendar()[:2], backup['filename'])
+    kept = set(days.values()) | set(weeks.values())
+    kept.update(backup['filename'] for backup in backups if not backup['automatic'])
     
-    for match in matches:
-        include_file = match.group(1)
-        with open(os.path.join(TEMPLATE_DIR, include_file), 'r', encoding='utf-8') as f:
-            include_content = f.read()
-        content = content.replace(match.group(0), include_content)
+    horizon = time.time() - BACKUP_KEEP_HOURLY * 3600
+    for backup in backups:
+        if backup['automatic'] and backup['type'] == 'incremental':
+            if backup['base'] in kept and backup['timestamp'] >= horizon:
+                hours.setdefault(int(backup['timestamp'] // 3600), backup['filename'])
+    kept.update(hours.values())
     
-    # Replace any variables
-    for key, value in kwargs.items():
-        content = content.replace('{{' + key + '}}', str(value))
+    removed = []
+    for backup in backups:
+        if backup['filename'] not in kept:
+            os.remove(os.path.join(BACKUP_DIR, backup['filename']))
+            removed.append(backup['filename'])
+    if removed:
+        logging.info(f"Backup retention removed: {', '.join(removed)}")
+    return removed
+
+def take_scheduled_backup(job, full):
+    """Scheduler job: a full snapshot, or an incremental one when the chain allows it"""
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    if not full:
+        base = latest_base_snapshot(list_backups())
+        if base is not None:
+            job.filename = write_incremental_backup(
+                os.path.join(BACKUP_DIR, f'{BACKUP_AUTO_PREFIX}incremental_{timestamp}.zip'), base)
+    if job.filename is None:
+        job.filename = write_backup_zip(
+            os.path.join(BACKUP_DIR, f'{BACKUP_AUTO_PREFIX}backup_{timestamp}.db.zip'), job)
+    apply_backup_retention()
+    job.message = f'定时备份完成: {job.filename}'
+    logging.info(f"Scheduled backup created: {job.filename}")
+
+class BackupScheduler:
+    """Background thread that takes automatic backups on a schedule.
+
+    Due times are worked out from the archives on disk, so a restart does
+    not cause an extra backup. Incremental backups are skipped while
+    nothing has changed.
+    """
+
+    def __init__(self):
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.job = None
+        self.last_check = 0
+
+    def start(self):
+        if self.thread is None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, name='backup-scheduler', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stop_event.wait(BACKUP_SCHEDULE_CHECK):
+            try:
+                self.check()
+            except Exception as e:
+                logging.error(f"Backup scheduler check failed: {str(e)}")
+
+    def check(self):
+        if self.job is not None and self.job.finished is None:
+            return
+        now = time.time()
+        backups = list_backups()
+        base = latest_base_snapshot(backups)
+        automatic_fulls = [b for b in backups if b['automatic'] and b['type'] == 'full']
+        if base is None or not automatic_fulls or now - automatic_fulls[0]['timestamp'] >= BACKUP_FULL_INTERVAL:
+            full = True
+        else:
+            last_point = max(backups[0]['timestamp'], self.last_check)
+            if now - last_point < BACKUP_INCREMENTAL_INTERVAL:
+                return
+            # Nothing to do while the database is where the newest backup of this chain left it
+            newest = next((b for b in backups if b['type'] == 'incremental' and b.get('base') == base['filename']),
+                          base)
+            with get_db_pool().get_connection() as conn:
+                if snapshot_position(conn) in ((base['instance'], base['seq']), (newest['instance'], newest['seq'])):
+                    self.last_check = now
+                    return
+            full = False
+        self.last_check = now
+        self.job = maintenance_jobs.submit('scheduled', lambda job: take_scheduled_backup(job, full), '定时备份失败')
+
+backup_scheduler = BackupScheduler()
+
+# Restore
+def extract_database(zip_path, dest_path):
+    """Unpack the database member of a full backup archive to ``dest_path``"""
+    with zipfile.ZipFile(zip_path) as zipf:
+        members = [name for name in zipf.namelist() if name.endswith('.db')]
+        if not members:
+            raise ValueError('备份文件中没有数据库')
+        with zipf.open(members[0]) as source, open(dest_path, 'wb') as dest:
+            shutil.copyfileobj(source, dest, BACKUP_ZIP_CHUNK)
+
+def apply_incremental_backup(conn, zip_path):
+    """Replay an incremental backup onto ``conn`` (autocommit, schema up to date)"""
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(SurgerySchedule)')}
+    with zipfile.ZipFile(zip_path) as zipf, zipf.open('changes.ndjson') as changes:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for line in io.TextIOWrapper(changes, encoding='utf-8'):
+                change = json.loads(line)
+                if change['op'] == 'delete':
+                    conn.execute('DELETE FROM SurgerySchedule WHERE ID=?', (change['ID'],))
+                else:
+                    row = {name: value for name, value in change['row'].items() if name in columns}
+                    # Not INSERT OR REPLACE: its implicit delete would bypass the delete triggers
+                    conn.execute('DELETE FROM SurgerySchedule WHERE ID=?', (row['ID'],))
+                    conn.execute(
+                        f'INSERT INTO SurgerySchedule ({", ".join(row)}) '
+                        f'VALUES ({", ".join("?" * len(row))})', list(row.values()))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+def choose_restore_point(filename=None, point_in_time=None):
+    """Backups needed to restore: ``[full]`` or ``[full, incremental]``.
+
+    Either a specific archive, or the newest restorable point taken at or
+    before ``point_in_time`` ('YYYY-MM-DD HH:MM[:SS]').
+    """
+    backups = list_backups()
+    by_name = {backup['filename']: backup for backup in backups}
+    if filename:
+        candidates = [by_name[filename]] if filename in by_name else []
+    else:
+        limit = datetime.strptime(point_in_time.replace('T', ' ')[:16], '%Y-%m-%d %H:%M').timestamp() + 59
+        candidates = [backup for backup in backups if backup['timestamp'] <= limit]
+    for backup in candidates:
+        if backup['type'] == 'full':
+            return [backup]
+        if backup['type'] == 'incremental' and backup['base'] in by_name:
+            return [by_name[backup['base']], backup]
+    raise ValueError('没有可用于恢复的备份')
+
+def check_database_file(path):
+    """Integrity and schema check of a database file before it may replace the live one"""
+    with open(path, 'rb') as f:
+        if f.read(16) != b'SQLite format 3\x00':
+            raise ValueError('不是有效的 SQLite 数据库文件')
+    conn = sqlite3.connect(path)
+    try:
+        problems = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+        if problems != ['ok']:
+            raise ValueError(f'数据库完整性检查失败: {"; ".join(problems[:5])}')
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(SurgerySchedule)')}
+        if not columns:
+            raise ValueError('数据库中没有 SurgerySchedule 表')
+        missing = [column for column in ARCHIVE_COLUMNS if column not in columns]
+        if missing:
+            raise ValueError(f'SurgerySchedule 表缺少字段: {", ".join(missing)}')
+        if get_schema_version(conn) > MIGRATIONS[-1][0]:
+            raise ValueError('该数据库来自更新版本的程序')
+    finally:
+        conn.close()
+
+def prepare_restored_database(path, incrementals=()):
+    """Bring a checked database file up to date so it can be swapped in"""
+    conn = sqlite3.connect(path)
+    try:
+        conn.isolation_level = None
+        run_migrations(conn)
+        for backup in incrementals:
+            apply_incremental_backup(conn, os.path.join(BACKUP_DIR, backup['filename']))
+        # The restored history diverges from the old chain: start a new one
+        conn.execute("UPDATE DatabaseInfo SET Value=lower(hex(randomblob(8))) WHERE Key='instance'")
+    finally:
+        conn.close()
+
+def build_restored_database(chain, dest_path):
+    """Rebuild a database file from a restore chain, ready to be swapped in"""
+    extract_database(os.path.join(BACKUP_DIR, chain[0]['filename']), dest_path)
+    check_database_file(dest_path)
+    prepare_restored_database(dest_path, chain[1:])
+
+# Backup upload
+BACKUP_UPLOAD_MAX = 50 * 1024 * 1024   # Largest accepted upload (bytes)
+MULTIPART_CHUNK = 64 * 1024            # Bytes read from the socket at a time
+
+def save_multipart_file(rfile, content_type, length, field, dest):
+    """Stream the file field ``field`` of a multipart/form-data body into ``dest``.
+
+    The body is scanned for the boundary chunk by chunk, so an upload is
+    never held in memory. The rest of the body is consumed so the
+    connection stays usable. Returns the uploaded file name.
+    """
+    match = re.search(r'boundary="?([^";]+)"?', content_type or '')
+    if not (content_type or '').startswith('multipart/form-data') or not match:
+        raise ValueError('请以 multipart/form-data 方式上传文件')
+    delimiter = b'\r\n--' + match.group(1).encode('latin-1')
+    remaining = length
+    # The first boundary is not preceded by a line break; pretend it is
+    buffer = b'\r\n'
+
+    def fill():
+        nonlocal buffer, remaining
+        if remaining <= 0:
+            raise ValueError('上传数据不完整')
+        chunk = rfile.read(min(MULTIPART_CHUNK, remaining))
+        if not chunk:
+            raise ValueError('上传数据不完整')
+        remaining -= len(chunk)
+        buffer += chunk
+
+    def copy_part(target):
+        # Copy (or skip) part data up to the next delimiter, keeping a tail that may hold its start
+        nonlocal buffer
+        keep = len(delimiter) - 1
+        while True:
+            index = buffer.find(delimiter)
+            if index >= 0:
+                if target is not None:
+                    target.write(buffer[:index])
+                buffer = buffer[index + len(delimiter):]
+                return
+            if len(buffer) > keep:
+                if target is not None:
+                    target.write(buffer[:-keep])
+                buffer = buffer[-keep:]
+            fill()
+
+    copy_part(None)     # Preamble
+    while True:
+        while len(buffer) < 2:
+            fill()
+        if buffer.startswith(b'--'):
+            raise ValueError('未找到上传的文件')
+        while b'\r\n\r\n' not in buffer:
+            if len(buffer) > MULTIPART_CHUNK:
+                raise ValueError('上传数据格式错误')
+            fill()
+        head, buffer = buffer.split(b'\r\n\r\n', 1)
+        disposition = re.search(rb'name="([^"]*)"(?:; *filename="([^"]*)")?', head)
+        if disposition and disposition.group(1).decode('utf-8', 'replace') == field:
+            copy_part(dest)
+            while remaining > 0:
+                chunk = rfile.read(min(MULTIPART_CHUNK, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+            return (disposition.group(2) or b'').decode('utf-8', 'replace')
+        copy_part(None)
+
+def unpack_uploaded_backup(upload_path, dest_path):
+    """Turn an uploaded .zip backup or plain .db file into a database file at ``dest_path``"""
+    if zipfile.is_zipfile(upload_path):
+        extract_database(upload_path, dest_path)
+        os.remove(upload_path)
+    else:
+        os.replace(upload_path, dest_path)
+
+def swap_database(new_path=None):
+    """Replace the live database with ``new_path``, or with an empty one.
+
+    Writes are held off and the pool drains, so every connection is closed
+    before the files change; requests meanwhile just wait. ``new_path``
+    must be on the same file system so the rename is atomic.
+    """
+    with get_db_writer().paused(), get_db_pool().paused():
+        # The old WAL must never be replayed onto the new file
+        for path in (DB_PATH + '-wal', DB_PATH + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        if new_path is not None:
+            os.replace(new_path, DB_PATH)
+        elif os.path.exists(DB_PATH):
+            os.remove(DB_PATH)
+        init_db()
+        schedule_cache.clear()
+    event_broker.publish('reset', {})
+
+# Archiving
+ARCHIVE_DEFAULT_DAYS = 365          # Default cutoff: records older than this many days
+ARCHIVE_BATCH_SIZE = 500            # IDs covered by one archive transaction
+ARCHIVE_BATCH_PAUSE = 0.05          # Seconds between batches, so requests get the writer
+ARCHIVE_MODE = 'table'              # Default destination, one of ARCHIVE_MODES
+# table: SurgeryScheduleArchive; yearly: SurgeryScheduleArchive_<year>;
+# attached: SurgeryScheduleArchive in archive/surgery_archive_<year>.db (keeps surgery.db small)
+ARCHIVE_MODES = ('table', 'yearly', 'attached')
+ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+
+ARCHIVE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        Department TEXT NOT NULL,
+        Date TEXT NOT NULL,
+        BedNumber TEXT NOT NULL,
+        PatientName TEXT NOT NULL,
+        Gender TEXT NOT NULL,
+        Age INTEGER NOT NULL,
+        HospitalNumber TEXT NOT NULL,
+        Diagnosis TEXT NOT NULL,
+        Operation TEXT NOT NULL,
+        MainSurgeon TEXT NOT NULL,
+        Assistant TEXT NOT NULL,
+        AnesthesiaDoctor TEXT NOT NULL,
+        AnesthesiaType TEXT NOT NULL,
+        PreOpPrep TEXT,
+        OperationOrder INTEGER NOT NULL,
+        Creator TEXT NOT NULL,
+        Editor TEXT NOT NULL,
+        CreatedAt TIMESTAMP,
+        UpdatedAt TIMESTAMP
+    )
+'''
+
+def archive_target(mode, year):
+    """(attached schema or None, table) that receives archived rows of ``year``"""
+    if mode == 'yearly':
+        return None, f'SurgeryScheduleArchive_{year}'
+    if mode == 'attached':
+        return f'archive_{year}', 'SurgeryScheduleArchive'
+    return None, 'SurgeryScheduleArchive'
+
+def archive_batch(conn, run_id, cutoff, mode, low, high):
+    """Move the archivable rows with low < ID <= high; returns the (date, department) slices moved.
+
+    ``conn`` is the writer connection in autocommit mode. Rows are copied
+    with INSERT OR IGNORE, so a batch interrupted after the copy simply
+    runs again. Only rows found in the archive with identical content are
+    then deleted: an archive file that outlived a reset can already hold a
+    different row under the same ID, and such rows stay in the live table.
+    Attached archive files are committed before the rows are deleted from
+    the main file, because WAL mode cannot commit both files atomically.
+    The checkpoint advances in the same transaction as the delete.
+    """
+    window = (low, high, cutoff)
+    rows = conn.execute('''
+        SELECT DISTINCT Date, Department FROM main.SurgerySchedule
+        WHERE ID > ? AND ID <= ? AND Date < ?
+    ''', window).fetchall()
+    years = sorted({date[:4] for date, _ in rows})
+    for year in years:
+        if not re.fullmatch(r'\d{4}', year):
+            raise ValueError(f'记录日期格式异常，无法归档: {year}')
     
-    return content
+    columns = ', '.join(ARCHIVE_COLUMNS)
+    attached = []
+    try:
+        for year in years:
+            schema, _ = archive_target(mode, year)
+            if schema:
+                os.makedirs(ARCHIVE_DIR, exist_ok=True)
+                conn.execute(f'ATTACH DATABASE ? AS {schema}',
+                             (os.path.join(ARCHIVE_DIR, f'surgery_archive_{year}.db'),))
+                attached.append(schema)
+        
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for year in years:
+                schema, table = archive_target(mode, year)
+                target = f'{schema}.{table}' if schema else table
+                conn.execute(ARCHIVE_TABLE_SQL.format(name=target))
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO {target} ({columns})
+                    SELECT {columns} FROM main.SurgerySchedule
+                    WHERE ID > ? AND ID <= ? AND Date < ? AND substr(Date, 1, 4) = ?
+                ''', window + (year,))
+            if attached:
+                # Rows must be safe in the archive file before they leave the main one
+                conn.execute('COMMIT')
+                conn.execute('BEGIN IMMEDIATE')
+            moved = 0
+            for year in years:
+                schema, table = archive_target(mode, year)
+                target = f'{schema}.{table}' if schema else table
+                moved += conn.execute(f'''
+                    DELETE FROM main.SurgerySchedule WHERE ID IN (
+                        SELECT ID FROM (
+                            SELECT {columns} FROM main.SurgerySchedule
+                            WHERE ID > ? AND ID <= ? AND Date < ? AND substr(Date, 1, 4) = ?
+                            INTERSECT
+                            SELECT {columns} FROM {target} WHERE ID > ? AND ID <= ?))
+                ''', window + (year, low, high)).rowcount
+            left = conn.execute('''
+                SELECT COUNT(*) FROM main.SurgerySchedule WHERE ID > ? AND ID <= ? AND Date < ?
+            ''', window).fetchone()[0]
+            if left:
+                logging.warning(f"Archive run {run_id}: {left} records in IDs {low}-{high} kept, "
+                                f"the archive already holds different records with the same IDs")
+            conn.execute('''
+                UPDATE ArchiveProgress SET LastID=?, Moved=Moved + ?, UpdatedAt=CURRENT_TIMESTAMP
+                WHERE ID=?
+            ''', (high, moved, run_id))
+            conn.execute("UPDATE TableCounts SET Count = Count + ? WHERE Name = 'archived'", (moved,))
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+    finally:
+        for schema in attached:
+            conn.execute(f'DETACH DATABASE {schema}')
+    return [tuple(row) for row in rows]
+
+def run_archive(job, run_id):
+    """Maintenance job: work through an archive run from its last checkpoint"""
+    with get_db_pool().get_connection() as conn:
+        cutoff, mode, last_id, max_id = conn.execute(
+            'SELECT Cutoff, Mode, LastID, MaxID FROM ArchiveProgress WHERE ID=?', (run_id,)).fetchone()
+    first = last_id
+    while last_id < max_id:
+        high = min(last_id + ARCHIVE_BATCH_SIZE, max_id)
+        with get_db_writer().exclusive() as conn:
+            moved_slices = archive_batch(conn, run_id, cutoff, mode, last_id, high)
+        schedule_cache.invalidate(*moved_slices)
+        last_id = high
+        job.progress = int((last_id - first) * 99 / (max_id - first))
+        time.sleep(ARCHIVE_BATCH_PAUSE)
+    
+    def finish(conn):
+        conn.execute("UPDATE ArchiveProgress SET Status='done', UpdatedAt=CURRENT_TIMESTAMP WHERE ID=?", (run_id,))
+        # Every archived record left a change-log row
+        prune_change_log(conn)
+        moved = conn.execute('SELECT Moved FROM ArchiveProgress WHERE ID=?', (run_id,)).fetchone()[0]
+        # Whatever is still below the cutoff collided with an existing archive row
+        kept = conn.execute('SELECT COUNT(*) FROM SurgerySchedule WHERE Date < ? AND ID <= ?',
+                            (cutoff, max_id)).fetchone()[0]
+        return moved, kept
+    moved, kept = get_db_writer().execute(finish)
+    event_broker.publish('reset', {})
+    job.message = f'已归档 {moved} 条记录'
+    if kept:
+        job.message += f'，{kept} 条记录因归档中已有相同ID的不同记录而保留'
+    logging.info(f"Archive run {run_id} finished: {moved} records before {cutoff} ({mode})")
+
+def start_archive(cutoff=None, mode=ARCHIVE_MODE):
+    """Queue an archive run; an unfinished run is resumed instead of starting a new one.
+
+    Returns (job, resumed), or (None, False) when there is nothing to resume
+    and no ``cutoff`` was given.
+    """
+    def create(conn):
+        row = conn.execute("SELECT ID FROM ArchiveProgress WHERE Status='running' ORDER BY ID LIMIT 1").fetchone()
+        if row:
+            return row[0], True
+        if cutoff is None:
+            return None, False
+        low, high = conn.execute('SELECT MIN(ID), MAX(ID) FROM SurgerySchedule WHERE Date < ?', (cutoff,)).fetchone()
+        cursor = conn.execute('''
+            INSERT INTO ArchiveProgress (Cutoff, Mode, LastID, MaxID, Status)
+            VALUES (?, ?, ?, ?, 'running')
+        ''', (cutoff, mode, (low or 1) - 1, high or 0))
+        return cursor.lastrowid, False
+    
+    run_id, resumed = get_db_writer().execute(create)
+    if run_id is None:
+        return None, False
+    job = maintenance_jobs.submit('archive', lambda job: run_archive(job, run_id), '归档失败')
+    return job, resumed
+
+# Writes shared by the single-record and bulk endpoints
+INSERT_SURGERY_SQL = '''
+    INSERT INTO SurgerySchedule (
+        Department, Date, BedNumber, PatientName, Gender, Age,
+        HospitalNumber, Diagnosis, Operation, MainSurgeon,
+        Assistant, AnesthesiaDoctor, AnesthesiaType, PreOpPrep,
+        OperationOrder, Creator, Editor
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+UPDATE_SURGERY_SQL = '''
+    UPDATE SurgerySchedule 
+    SET Date=?, BedNumber=?, PatientName=?, Gender=?, Age=?,
+        HospitalNumber=?, Diagnosis=?, Operation=?, MainSurgeon=?,
+        Assistant=?, AnesthesiaDoctor=?, AnesthesiaType=?,
+        PreOpPrep=?, OperationOrder=?, Editor=?, UpdatedAt=CURRENT_TIMESTAMP,
+        Version=Version + 1
+    WHERE ID=?
+'''
+
+SURGERY_FIELDS = ['BedNumber', 'PatientName', 'Gender', 'Age', 'HospitalNumber', 'Diagnosis',
+                  'Operation', 'MainSurgeon', 'Assistant', 'AnesthesiaDoctor', 'AnesthesiaType']
+
+def insert_params(data, creator):
+    return (
+        data['Department'], data['Date'], data['BedNumber'],
+        data['PatientName'], data['Gender'], data['Age'],
+        data['HospitalNumber'], data['Diagnosis'], data['Operation'],
+        data['MainSurgeon'], data['Assistant'], data['AnesthesiaDoctor'],
+        data['AnesthesiaType'], data.get('PreOpPrep', ''),
+        data['OperationOrder'], creator, creator
+    )
+
+def update_params(data, editor):
+    return (
+        data['Date'], data['BedNumber'], data['PatientName'],
+        data['Gender'], data['Age'], data['HospitalNumber'],
+        data['Diagnosis'], data['Operation'], data['MainSurgeon'],
+        data['Assistant'], data['AnesthesiaDoctor'], data['AnesthesiaType'],
+        data.get('PreOpPrep', ''), data['OperationOrder'],
+        editor, data['ID']
+    )
+
+# Columns copied into SurgeryScheduleArchive (the live table has grown since)
+ARCHIVE_COLUMNS = ['ID', 'Department', 'Date'] + SURGERY_FIELDS + [
+    'PreOpPrep', 'OperationOrder', 'Creator', 'Editor', 'CreatedAt', 'UpdatedAt']
+
+# Bulk write endpoint
+BULK_MAX_ITEMS = 500        # Operations accepted by /api/surgery/batch in one call
+
+class BatchConflict(Exception):
+    """Raised inside a bulk write job to roll it back; carries the per-item results"""
+
+    def __init__(self, results):
+        super().__init__('批量操作存在冲突，所有修改已撤销')
+        self.results = results
+
+def batch_int(value):
+    """An ID or Version from a bulk request as int, or None if it is missing or not a number"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def apply_surgery_batch(conn, data):
+    """Apply a bulk request as one job on the writer connection.
+
+    ``data`` holds ``add`` (new records), ``edit`` (records with ``ID`` and
+    ``Version``, or ``lastUpdate`` from older clients), ``delete`` (IDs) and ``reorder`` ({ID, OperationOrder})
+    lists. Every item is checked first; if any is invalid or stale, or an ID
+    appears more than once, nothing is written and BatchConflict is raised. Returns (results, changes) where
+    changes is a list of (event type, (date, department), ID).
+    """
+    editor = data.get('Editor') or data.get('Creator') or '系统用户'
+    adds = data.get('add', [])
+    edits = [dict(item, ID=batch_int(item.get('ID'))) for item in data.get('edit', [])]
+    deletes = [batch_int(surgery_id) for surgery_id in data.get('delete', [])]
+    reorders = [dict(item, ID=batch_int(item.get('ID'))) for item in data.get('reorder', [])]
+    results = {
+        'add': [{'index': i, 'status': 'ok'} for i in range(len(adds))],
+        'edit': [{'ID': item['ID'], 'status': 'ok'} for item in edits],
+        'delete': [{'ID': surgery_id, 'status': 'ok'} for surgery_id in deletes],
+        'reorder': [{'ID': item['ID'], 'status': 'ok'} for item in reorders],
+    }
+    conflict = False
+
+    for result, item in zip(results['add'], adds):
+        missing = [field for field in ['Department', 'Date', 'OperationOrder'] + SURGERY_FIELDS if field not in item]
+        if missing:
+            result.update(status='invalid', message=f'缺少字段: {", ".join(missing)}')
+            conflict = True
+
+    for kind in ('edit', 'delete', 'reorder'):
+        for result in results[kind]:
+            if result['ID'] is None:
+                result.update(status='invalid', message='缺少或无效的ID')
+                conflict = True
+
+    # Current state of every row the batch touches, read once
+    ids = [surgery_id for surgery_id in [item['ID'] for item in edits + reorders] + deletes if surgery_id is not None]
+    current = {}
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        current.update((row[0], row[1:]) for row in conn.execute(
+            f'SELECT ID, Version, UpdatedAt, Date, Department FROM SurgerySchedule WHERE ID IN ({", ".join("?" * len(chunk))})',
+            chunk))
+
+    for result, item in zip(results['edit'], edits):
+        if item['ID'] is None:
+            continue
+        row = current.get(item['ID'])
+        version = batch_int(item.get('Version'))
+        if row is None:
+            result.update(status='missing', message='记录不存在')
+            conflict = True
+        elif item.get('Version') is not None and version is None:
+            result.update(status='invalid', message='无效的Version')
+            conflict = True
+        elif (row[0] != version if version is not None else row[1] != item.get('lastUpdate')):
+            result.update(status='conflict', message='该记录已被其他用户修改')
+            conflict = True
+        else:
+            missing = [field for field in ['Date', 'OperationOrder'] + SURGERY_FIELDS if field not in item]
+            if missing:
+                result.update(status='invalid', message=f'缺少字段: {", ".join(missing)}')
+                conflict = True
+    for result, item in zip(results['reorder'], reorders):
+        if item['ID'] is None:
+            continue
+        if item['ID'] not in current:
+            result.update(status='missing', message='记录不存在')
+            conflict = True
+        elif 'OperationOrder' not in item:
+            result.update(status='invalid', message='缺少字段: OperationOrder')
+            conflict = True
+    for result in results['delete']:
+        if result['ID'] is not None and result['ID'] not in current:
+            # Already gone: the outcome the client asked for, so not a conflict
+            result['status'] = 'missing'
+    # One record may only be touched once, or a later step would silently act on what an earlier one did
+    repeated = {surgery_id for surgery_id, count in Counter(ids).items() if count > 1}
+    for kind in ('edit', 'delete', 'reorder'):
+        for result in results[kind]:
+            if result['ID'] in repeated:
+                result.update(status='invalid', message='同一记录在请求中出现多次')
+                conflict = True
+
+    if conflict:
+        raise BatchConflict(results)
+
+    changes = []
+    conn.executemany('DELETE FROM SurgerySchedule WHERE ID=?', [(surgery_id,) for surgery_id in deletes])
+    changes.extend(('delete', tuple(current[surgery_id][2:]), surgery_id) for surgery_id in deletes if surgery_id in current)
+
+    conn.executemany(UPDATE_SURGERY_SQL, [update_params(item, editor) for item in edits])
+    for item in edits:
+        _, _, old_date, department = current[item['ID']]
+        changes.append(('edit', (old_date, department), item['ID']))
+        changes.append(('edit', (item['Date'], department), item['ID']))
+
+    conn.executemany('''
+        UPDATE SurgerySchedule
+        SET OperationOrder=?, Editor=?, UpdatedAt=CURRENT_TIMESTAMP, Version=Version + 1
+        WHERE ID=?
+    ''', [(item['OperationOrder'], editor, item['ID']) for item in reorders])
+    changes.extend(('reorder', tuple(current[item['ID']][2:]), item['ID']) for item in reorders)
+
+    if adds:
+        # IDs are AUTOINCREMENT and the write lock is held, so new rows are exactly those above the old maximum
+        last_id = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='SurgerySchedule'").fetchone()
+        last_id = last_id[0] if last_id else 0
+        conn.executemany(INSERT_SURGERY_SQL, [insert_params(item, item.get('Creator', editor)) for item in adds])
+        new_ids = [row[0] for row in conn.execute(
+            'SELECT ID FROM SurgerySchedule WHERE ID > ? ORDER BY ID', (last_id,))]
+        for result, item, surgery_id in zip(results['add'], adds, new_ids):
+            result['ID'] = surgery_id
+            changes.append(('add', (item['Date'], item['Department']), surgery_id))
+
+    return results, changes
+
+class Route:
+    """One entry of the route table: a handler per allowed method and per-route settings"""
+
+    def __init__(self, name, handlers, body_limit=REQUEST_BODY_MAX, admin=False, stream_body=False):
+        self.name = name
+        self.handlers = handlers
+        self.allow = ', '.join(sorted(handlers))
+        self.body_limit = body_limit
+        self.admin = admin
+        # The handler reads the body itself, piece by piece (uploads)
+        self.stream_body = stream_body
+
+class Router:
+    """Exact paths are looked up in a dict; paths ending in ``*`` match by prefix"""
+
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = []
+
+    def add(self, path, body_limit=REQUEST_BODY_MAX, admin=False, stream_body=False, **handlers):
+        route = Route(path, handlers, body_limit, admin, stream_body)
+        if path.endswith('*'):
+            self.prefixes.append((path[:-1], route))
+        else:
+            self.exact[path] = route
+        return route
+
+    def match(self, path):
+        route = self.exact.get(path)
+        if route is None:
+            for prefix, candidate in self.prefixes:
+                if path.startswith(prefix):
+                    return candidate
+        return route
+
+class CountingWriter:
+    """Wraps a handler's ``wfile`` to count the bytes sent for each response"""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.wfile.write(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.wfile, name)
 
 class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
-    def do_GET(self):
-        parsed_path = urlparse(self.path)
-        path = parsed_path.path
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+
+    def handle_one_request(self):
+        if not isinstance(self.wfile, CountingWriter):
+            self.wfile = CountingWriter(self.wfile)
+        self.wfile.count = 0
+        self.command = None
+        self.path = ''
+        self.route = None
+        self.status_code = None
+        self.in_flight = False
+        self.started = time.perf_counter()
+        request_context.db_time = 0.0
+        try:
+            super().handle_one_request()
+        finally:
+            if self.in_flight:
+                metrics.inc('surgery_http_requests_in_flight', (), -1)
+            if self.status_code is not None:
+                self.record_request()
+        # Give the worker back instead of idling on keep-alive while others queue up
+        if getattr(self.server, 'is_busy', None) and self.server.is_busy():
+            self.close_connection = True
+
+    def parse_request(self):
+        # Latency is measured from the request line, not from the start of a keep-alive wait
+        self.started = time.perf_counter()
+        self.in_flight = True
+        metrics.inc('surgery_http_requests_in_flight', (), 1)
+        return super().parse_request()
+
+    def log_request(self, code='-', size='-'):
+        # Keep the status for the access log instead of printing a request line to stderr
+        self.status_code = int(code)
+
+    def log_message(self, format, *args):
+        logging.warning(f"{self.client_address[0]} - {format % args}")
+
+    def access_route(self):
+        return self.route.name if self.route is not None else urlparse(self.path).path
+
+    def record_request(self):
+        """Feed the finished request to /metrics and the access log"""
+        elapsed = time.perf_counter() - self.started
+        route = self.route.name if self.route is not None else 'unmatched'
+        metrics.inc('surgery_http_requests_total', (route, self.command or '-', str(self.status_code)))
+        metrics.observe('surgery_http_request_duration_seconds', (route,), elapsed)
+        access_log.record({
+            'time': datetime.now().isoformat(timespec='milliseconds'),
+            'client': self.client_address[0],
+            'method': self.command or '-',
+            'route': self.access_route(),
+            'status': self.status_code,
+            'bytes': self.wfile.count,
+            'dbMs': round(request_context.db_time * 1000, 2),
+            'totalMs': round(elapsed * 1000, 2),
+        })
+
+    def dispatch(self):
+        """Look the path up in the route table and call the handler for the method"""
+        self.url = urlparse(self.path)
+        self._params = None
+        self._body = None
+        self.route = router.match(self.url.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        # A body left unread would be taken for the next request, so such connections are closed
+        if self.route is None:
+            self.close_connection = self.close_connection or length > 0
+            self.send_error(404)
+            return
         
-        if path == '/admin/login':
-            self.send_file('templates/admin_login.html')
+        handler = self.route.handlers.get(self.command)
+        if handler is None:
+            self.close_connection = self.close_connection or length > 0
+            self.send_body(json.dumps({'success': False, 'message': '不支持的请求方法'}).encode(),
+                           'application/json', {'Allow': self.route.allow}, status=405)
             return
-        elif path == '/db/maintenance':
-            if self.is_admin_authenticated():
-                self.send_file('templates/db_maintenance.html')
-            else:
-                self.redirect_to_admin_login()
+        if length > self.route.body_limit:
+            self.close_connection = True
+            self.send_body(json.dumps({'success': False, 'message': '请求内容过大'}).encode(),
+                           'application/json', status=413)
             return
-        elif path == '/':
-            # Check if user is authenticated
-            params = parse_qs(parsed_path.query)
-            is_authenticated = params.get('auth', [''])[0] == 'true'
-            
-            if is_authenticated:
-                self.send_file('templates/surgery_schedule.html')
-            else:
-                self.send_file('templates/surgery_login.html')
-                
-        elif path == '/api/surgeries':
-            self.handle_get_surgeries()
-        elif path == '/api/surgeries/export':
-            self.handle_export_surgeries()
-        elif path == '/api/surgeries/history':
-            self.handle_get_history()
-        elif path == '/api/db/maintenance':
-            self.handle_db_maintenance()
-        elif path == '/api/db/stats':
-            self.handle_get_db_stats()
-        elif path == '/api/database/backups':
-            self.handle_get_backups()
-        elif path == '/api/database/logs':
-            self.handle_get_logs()
-        elif path.startswith('/static/'):
-            # Serve static files
-            self.path = path
-            return http.server.SimpleHTTPRequestHandler.do_GET(self)
-        else:
-            self.send_error(404)
+        try:
+            if self.route.admin and not self.is_admin_authenticated():
+                self.redirect_to_admin_login()
+                return
+            handler(self)
+        finally:
+            # Consume a body the handler ignored, or it would be parsed as the next request
+            if length > 0 and self._body is None and not self.route.stream_body:
+                self.read_body()
 
-    def do_POST(self):
-        parsed_path = urlparse(self.path)
-        path = parsed_path.path
-        
-        if path == '/api/surgery/login':
-            self.handle_surgery_login()
-        elif path == '/api/surgery/add':
-            self.handle_add_surgery()
-        elif path == '/api/surgery/edit':
-            self.handle_edit_surgery()
-        elif path == '/api/surgery/delete':
-            self.handle_delete_surgery()
-        elif path == '/api/database/backup':
-            self.handle_backup_database()
-        elif path == '/api/database/import':
-            self.handle_import_backup()
-        elif path == '/api/database/logs/clear':
-            self.handle_clear_logs()
-        elif path == '/api/admin/login':
-            self.handle_admin_login()
+    do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = dispatch
+
+    @property
+    def params(self):
+        """Query string parameters, parsed on first use"""
+        if self._params is None:
+            self._params = parse_qs(self.url.query)
+        return self._params
+
+    def read_body(self):
+        """Request body, read once (dispatch has already checked it against the route's limit)"""
+        if self._body is None:
+            self._body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        return self._body
+
+    def read_json(self):
+        return json.loads(self.read_body().decode('utf-8'))
+
+    def handle_index(self):
+        # Check if user is authenticated
+        if self.params.get('auth', [''])[0] == 'true':
+            self.send_file('templates/surgery_schedule.html')
         else:
-            self.send_error(404)
+            self.send_file('templates/surgery_login.html')
+
+    def handle_admin_login_page(self):
+        self.send_file('templates/admin_login.html')
+
+    def handle_maintenance_page(self):
+        self.send_file('templates/db_maintenance.html')
+
+    def handle_static(self):
+        self.send_file(unquote(self.url.path).lstrip('/'))
 
     def handle_surgery_login(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length).decode('utf-8')
-        data = json.loads(post_data)
+        data = self.read_json()
         
         username = data.get('username')
         password = data.get('password')
@@ -208,69 +2818,165 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
             })
 
     def handle_get_surgeries(self):
-        params = parse_qs(urlparse(self.path).query)
+        """Schedule of one department for one day.
+
+        Every (date, department) slice carries a version maintained by
+        triggers. The response ETag is that version, so unchanged days are
+        answered with 304, and ``?since=<version>`` returns only the records
+        changed or deleted after that version (the whole day if the version
+        is from another database, e.g. before a reset).
+        """
+        params = self.params
         date = params.get('date', [datetime.now().strftime('%Y-%m-%d')])[0]
         department = params.get('department', ['二病区'])[0]
-        
-        db_pool = DatabasePool()
+        since = params.get('since', [''])[0]
         
         try:
-            with db_pool.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT * FROM SurgerySchedule 
-                    WHERE Date = ? AND Department = ?
-                    ORDER BY OperationOrder
-                ''', (date, department))
-                
-                columns = [description[0] for description in cursor.description]
-                surgeries = [dict(zip(columns, row)) for row in cursor.fetchall()]
-                
-                # Set title based on department
-                title = "颌面外科手术安排表" if department == '手术麻醉科' else f'{department}手术安排表'
+            if since:
+                self.send_json(self.get_schedule_delta(date, department, since))
+                return
+            
+            cached, epoch = schedule_cache.get((date, department))
+            if cached is None:
+                with get_db_pool().get_connection() as conn:
+                    cursor = conn.cursor()
+                    # Read the version and the rows from the same snapshot
+                    cursor.execute('BEGIN')
+                    version = get_schedule_version(cursor, date, department)
+                    cursor.execute('''
+                        SELECT * FROM SurgerySchedule 
+                        WHERE Date = ? AND Department = ?
+                        ORDER BY OperationOrder
+                    ''', (date, department))
+                    
+                    columns = [description[0] for description in cursor.description]
+                    surgeries = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                    conn.commit()
                 
-                self.send_json({
+                cached = CachedBody(json.dumps({
                     'success': True,
                     'surgeries': surgeries,
-                    'title': f'{title} {date}'
-                })
+                    'title': schedule_title(date, department),
+                    'version': version
+                }).encode(), time.time(), 'application/json')
+                cached.version = version
+                schedule_cache.put((date, department), cached, epoch)
+            
+            etag = f'W/"{cached.version}"'
+            headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+            if self.is_not_modified(etag, cached.mtime):
+                self.send_response(304)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                return
+            self.send_entry(cached, headers)
         except Exception as e:
             self.send_json({
                 'success': False,
                 'message': str(e)
             })
 
+    def get_schedule_delta(self, date, department, since):
+        """Records of a day changed after version ``since``, or the full day if the log does not cover it"""
+        with get_db_pool().get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN')
+            try:
+                version = get_schedule_version(cursor, date, department)
+                oldest = cursor.execute('SELECT MIN(Seq) FROM SurgeryChanges').fetchone()[0]
+                since = parse_schedule_version(since, version)
+                full = (since is None or since > parse_schedule_version(version, version)
+                        or (oldest is not None and since < oldest - 1))
+                
+                if full:
+                    cursor.execute('''
+                        SELECT * FROM SurgerySchedule
+                        WHERE Date = ? AND Department = ?
+                        ORDER BY OperationOrder
+                    ''', (date, department))
+                else:
+                    cursor.execute('''
+                        SELECT * FROM SurgerySchedule
+                        WHERE ID IN (
+                            SELECT SurgeryID FROM SurgeryChanges
+                            WHERE Department = ? AND Date = ? AND Seq > ?
+                        )
+                        AND Date = ? AND Department = ?
+                        ORDER BY OperationOrder
+                    ''', (department, date, since, date, department))
+                columns = [description[0] for description in cursor.description]
+                surgeries = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                
+                deleted = []
+                if not full:
+                    cursor.execute('''
+                        SELECT DISTINCT SurgeryID FROM SurgeryChanges
+                        WHERE Department = ? AND Date = ? AND Seq > ?
+                    ''', (department, date, since))
+                    present = {surgery['ID'] for surgery in surgeries}
+                    deleted = [row[0] for row in cursor.fetchall() if row[0] not in present]
+            finally:
+                conn.commit()
+        
+        result = {
+            'success': True,
+            'full': full,
+            'version': version,
+            'title': schedule_title(date, department)
+        }
+        if full:
+            result['surgeries'] = surgeries
+        else:
+            result['changed'] = surgeries
+            result['deleted'] = deleted
+        return result
+
+    def handle_events(self):
+        """Server-Sent Events stream of schedule changes (add/edit/delete/reorder/reset)"""
+        params = self.params
+        departments = split_param(params, 'department')
+        last_event_id = self.headers.get('Last-Event-ID') or params.get('lastEventId', [''])[0]
+        
+        subscription = event_broker.subscribe(last_event_id, departments, limit=SSE_MAX_THREAD_CLIENTS)
+        if subscription is None:
+            self.send_body(json.dumps({'success': False, 'message': '实时推送连接数已满'}).encode(),
+                           'application/json', {'Retry-After': str(SSE_HEARTBEAT)}, status=503)
+            return
+        
+        try:
+            body = self.start_chunked('text/event-stream', {'Cache-Control': 'no-cache'})
+            body.write(f'retry: {SSE_HEARTBEAT * 1000}\n\n'.encode())
+            body.flush()
+            while not subscription.overflowed:
+                try:
+                    event = subscription.events.get(timeout=SSE_HEARTBEAT)
+                    body.write(format_sse(*event))
+                except queue.Empty:
+                    body.write(b': heartbeat\n\n')
+                body.flush()
+            body.write(format_sse('', 'reset', {}))
+            body.close()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            event_broker.unsubscribe(subscription)
+            self.close_connection = True
+
     def handle_add_surgery(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length).decode('utf-8')
-        data = json.loads(post_data)
+        data = self.read_json()
         
-        db_pool = DatabasePool()
+        def insert(conn):
+            return conn.execute(INSERT_SURGERY_SQL, insert_params(data, data['Creator'])).lastrowid
         
         try:
-            with db_pool.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT INTO SurgerySchedule (
-                        Department, Date, BedNumber, PatientName, Gender, Age,
-                        HospitalNumber, Diagnosis, Operation, MainSurgeon,
-                        Assistant, AnesthesiaDoctor, AnesthesiaType, PreOpPrep,
-                        OperationOrder, Creator, Editor
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    data['Department'], data['Date'], data['BedNumber'],
-                    data['PatientName'], data['Gender'], data['Age'],
-                    data['HospitalNumber'], data['Diagnosis'], data['Operation'],
-                    data['MainSurgeon'], data['Assistant'], data['AnesthesiaDoctor'],
-                    data['AnesthesiaType'], data.get('PreOpPrep', ''),
-                    data['OperationOrder'], data['Creator'], data['Creator']
-                ))
-                
-                conn.commit()
-                self.send_json({
-                    'success': True,
-                    'message': '手术安排添加成功'
-                })
+            surgery_id = get_db_writer().execute(insert)
+            schedule_cache.invalidate((data['Date'], data['Department']))
+            event_broker.publish_change('add', [(data['Date'], data['Department'])], surgery_id)
+            self.send_json({
+                'success': True,
+                'message': '手术安排添加成功'
+            })
         except Exception as e:
             self.send_json({
                 'success': False,
@@ -278,70 +2984,102 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
             })
 
     def handle_edit_surgery(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length).decode('utf-8')
-        data = json.loads(post_data)
+        data = self.read_json()
         
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        def update(conn):
+            # The slice the record is leaving, for cache invalidation and events
+            previous = conn.execute('SELECT Date, Department FROM SurgerySchedule WHERE ID=?',
+                                    (data['ID'],)).fetchone()
+
+            # Compare-and-swap: the row is only written if nobody changed it since it was read
+            if data.get('Version') is not None:
+                version = int(data['Version'])
+                cursor = conn.execute(UPDATE_SURGERY_SQL + ' AND Version=?',
+                                      update_params(data, data.get('Editor', '系统用户')) + (version,))
+                # The swap succeeded, so the stored version is the one after ours
+                return (version + 1 if cursor.rowcount == 1 else None), previous
+            # Older clients only know the timestamp they loaded
+            cursor = conn.execute(UPDATE_SURGERY_SQL + ' AND UpdatedAt=?',
+                                  update_params(data, data.get('Editor', '系统用户')) + (data.get('lastUpdate'),))
+            if cursor.rowcount != 1:
+                return None, previous
+            return conn.execute('SELECT Version FROM SurgerySchedule WHERE ID=?', (data['ID'],)).fetchone()[0], previous
         
         try:
-            # Check version before update
-            cursor.execute('SELECT UpdatedAt FROM SurgerySchedule WHERE ID=?', (data['ID'],))
-            result = cursor.fetchone()
-            if result and result[0] != data.get('lastUpdate'):
+            version, previous = get_db_writer().execute(update)
+            if version is None:
                 self.send_json({
                     'success': False,
                     'message': '该记录已被其他用户修改，请刷新后重试'
                 })
                 return
+            if previous:
+                # The record may have moved to another day: drop both slices
+                old_date, department = previous
+                schedule_cache.invalidate((old_date, department), (data['Date'], department))
+                event_broker.publish_change('edit', [(old_date, department), (data['Date'], department)], data['ID'])
 
-            # Proceed with update
-            cursor.execute('''
-                UPDATE SurgerySchedule 
-                SET Date=?, BedNumber=?, PatientName=?, Gender=?, Age=?,
-                    HospitalNumber=?, Diagnosis=?, Operation=?, MainSurgeon=?,
-                    Assistant=?, AnesthesiaDoctor=?, AnesthesiaType=?,
-                    PreOpPrep=?, OperationOrder=?, Editor=?, UpdatedAt=CURRENT_TIMESTAMP
-                WHERE ID=?
-            ''', (
-                data['Date'], data['BedNumber'], data['PatientName'],
-                data['Gender'], data['Age'], data['HospitalNumber'],
-                data['Diagnosis'], data['Operation'], data['MainSurgeon'],
-                data['Assistant'], data['AnesthesiaDoctor'], data['AnesthesiaType'],
-                data.get('PreOpPrep', ''), data['OperationOrder'],
-                data.get('Editor', '系统用户'), data['ID']
-            ))
+            self.send_json({
+                'success': True,
+                'message': '手术安排已更新',
+                'version': version
+            })
+        except Exception as e:
+            self.send_json({
+                'success': False,
+                'message': str(e)
+            })
+
+    def handle_surgery_batch(self):
+        """Bulk add/edit/delete/reorder applied atomically in one write transaction"""
+        data = self.read_json()
+        
+        try:
+            total = sum(len(data.get(kind, [])) for kind in ('add', 'edit', 'delete', 'reorder'))
+            if not total:
+                raise ValueError('未提供任何操作')
+            if total > BULK_MAX_ITEMS:
+                raise ValueError(f'一次最多提交 {BULK_MAX_ITEMS} 项操作')
+            
+            results, changes = get_db_writer().execute(apply_surgery_batch, data)
+            schedule_cache.invalidate(*[change[1] for change in changes])
+            for event_type, change_slice, surgery_id in dict.fromkeys(changes):
+                event_broker.publish_change(event_type, [change_slice], surgery_id)
             
-            conn.commit()
             self.send_json({
                 'success': True,
-                'message': '手术安排已更新'
+                'message': f'批量操作完成，共 {total} 项',
+                'results': results
+            })
+        except BatchConflict as e:
+            self.send_json({
+                'success': False,
+                'message': str(e),
+                'results': e.results
             })
         except Exception as e:
             self.send_json({
                 'success': False,
                 'message': str(e)
             })
-        finally:
-            conn.close()
 
     def handle_delete_surgery(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length).decode('utf-8')
-        data = json.loads(post_data)
+        data = self.read_json()
         
-        db_pool = DatabasePool()
+        def delete(conn):
+            row = conn.execute('SELECT Date, Department FROM SurgerySchedule WHERE ID=?', (data['id'],)).fetchone()
+            conn.execute('DELETE FROM SurgerySchedule WHERE ID=?', (data['id'],))
+            return row
         
         try:
-            with db_pool.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('DELETE FROM SurgerySchedule WHERE ID=?', (data['id'],))
-                conn.commit()
-                self.send_json({
-                    'success': True,
-                    'message': '手术安排已删除'
-                })
+            row = get_db_writer().execute(delete)
+            if row:
+                schedule_cache.invalidate(tuple(row))
+                event_broker.publish_change('delete', [tuple(row)], data['id'])
+            self.send_json({
+                'success': True,
+                'message': '手术安排已删除'
+            })
         except Exception as e:
             self.send_json({
                 'success': False,
@@ -349,23 +3087,24 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
             })
 
     def handle_export_surgeries(self):
-        params = parse_qs(urlparse(self.path).query)
+        params = self.params
         start_date = params.get('start_date', [''])[0]
         end_date = params.get('end_date', [''])[0]
         department = params.get('department', [''])[0]
-        
-        db_pool = DatabasePool()
+        export_format = params.get('format', ['csv'])[0].lower()
         
         try:
-            with db_pool.get_connection() as conn:
+            if export_format not in EXPORT_FORMATS:
+                raise ValueError(f'不支持的导出格式: {export_format}')
+            content_type, write_rows = EXPORT_FORMATS[export_format]
+            
+            with get_db_pool().get_connection() as conn:
                 cursor = conn.cursor()
+                columns = ', '.join(EXPORT_COLUMNS)
                 if department == 'all':
                     # Query for all departments
-                    query = '''
-                        SELECT Date, Department, BedNumber, PatientName, Gender, Age,
-                               HospitalNumber, Diagnosis, Operation, MainSurgeon,
-                               Assistant, AnesthesiaDoctor, AnesthesiaType, PreOpPrep,
-                               OperationOrder
+                    query = f'''
+                        SELECT {columns}
                         FROM SurgerySchedule
                         WHERE Date BETWEEN ? AND ?
                         ORDER BY Date, Department, OperationOrder
@@ -373,11 +3112,8 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
                     cursor.execute(query, (start_date, end_date))
                 else:
                     # Original single department query
-                    query = '''
-                        SELECT Date, Department, BedNumber, PatientName, Gender, Age,
-                               HospitalNumber, Diagnosis, Operation, MainSurgeon,
-                               Assistant, AnesthesiaDoctor, AnesthesiaType, PreOpPrep,
-                               OperationOrder
+                    query = f'''
+                        SELECT {columns}
                         FROM SurgerySchedule
                         WHERE Department = ?
                         AND Date BETWEEN ? AND ?
@@ -385,21 +3121,17 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
                     '''
                     cursor.execute(query, (department, start_date, end_date))
                 
-                rows = cursor.fetchall()
-                
-                output = io.StringIO()
-                writer = csv.writer(output)
-                writer.writerow(['日期', '病区', '床号', '姓名', '性别', '年龄',
-                               '住院号', '临床诊断', '术式', '主刀',
-                               '助手', '管床医师', '麻醉', '术前准备', '台次'])
-                writer.writerows(rows)
-                
-                self.send_response(200)
-                self.send_header('Content-Type', 'text/csv')
-                self.send_header('Content-Disposition', 
-                               f'attachment; filename=surgeries_{start_date}_to_{end_date}.csv')
-                self.end_headers()
-                self.wfile.write(output.getvalue().encode('utf-8-sig'))
+                headers = {
+                    'Content-Disposition': f'attachment; filename=surgeries_{start_date}_to_{end_date}.{export_format}'
+                }
+                body = self.start_chunked(content_type, headers)
+                try:
+                    write_rows(cursor, body)
+                    body.close()
+                except Exception as e:
+                    # Headers are already out; all we can do is cut the response short
+                    logging.error(f"Export aborted: {str(e)}")
+                    self.close_connection = True
                 
         except Exception as e:
             self.send_json({
@@ -408,15 +3140,13 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
             })
 
     def handle_get_history(self):
-        params = parse_qs(urlparse(self.path).query)
+        params = self.params
         start_date = params.get('start_date', [''])[0]
         end_date = params.get('end_date', [''])[0]
         department = params.get('department', [''])[0]
         
-        db_pool = DatabasePool()
-        
         try:
-            with db_pool.get_connection() as conn:
+            with get_db_pool().get_connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     SELECT * FROM SurgerySchedule 
@@ -446,26 +3176,84 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
                 'message': f'查询失败: {str(e)}'
             })
 
-    def handle_backup_database(self):
+    def handle_get_surgeries_batch(self):
+        """Schedules for several departments and dates in one request.
+
+        Accepts ``department`` (repeated or comma separated, or ``all``) and
+        either ``date`` (repeated or comma separated) or a ``start_date`` /
+        ``end_date`` range. Results are grouped as {department: {date: [...]}}.
+        """
+        params = self.params
+        departments = split_param(params, 'department')
+        dates = split_param(params, 'date')
+        start_date = params.get('start_date', [''])[0]
+        end_date = params.get('end_date', [''])[0]
+        
         try:
-            backup_dir = os.path.join(os.path.dirname(DB_PATH), 'backups')
-            os.makedirs(backup_dir, exist_ok=True)
-            
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            backup_file = os.path.join(backup_dir, f'surgery_backup_{timestamp}.db')
+            if not departments:
+                raise ValueError('未指定病区')
+            if not dates and not (start_date and end_date):
+                raise ValueError('未指定日期')
+            if len(dates) > BATCH_MAX_DATES:
+                raise ValueError(f'一次最多查询 {BATCH_MAX_DATES} 天')
             
-            shutil.copy2(DB_PATH, backup_file)
+            conditions = []
+            args = []
+            if 'all' not in departments:
+                conditions.append(f'Department IN ({", ".join("?" * len(departments))})')
+                args.extend(departments)
+            if dates:
+                conditions.append(f'Date IN ({", ".join("?" * len(dates))})')
+                args.extend(dates)
+            else:
+                conditions.append('Date BETWEEN ? AND ?')
+                args.extend([start_date, end_date])
             
-            zip_file = backup_file + '.zip'
-            with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                zipf.write(backup_file, os.path.basename(backup_file))
+            with get_db_pool().get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f'''
+                    SELECT * FROM SurgerySchedule
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY Department, Date, OperationOrder
+                ''', args)
+                
+                columns = [description[0] for description in cursor.description]
+                
+                # Requested (department, date) pairs are always present, even when empty
+                schedules = {}
+                if 'all' not in departments:
+                    for department in departments:
+                        schedules[department] = {date: [] for date in dates}
+                for row in cursor:
+                    surgery = dict(zip(columns, row))
+                    by_date = schedules.setdefault(surgery['Department'], {})
+                    by_date.setdefault(surgery['Date'], []).append(surgery)
+                
+                self.send_json({
+                    'success': True,
+                    'schedules': schedules
+                })
+        except Exception as e:
+            self.send_json({
+                'success': False,
+                'message': f'查询失败: {str(e)}'
+            })
+
+    def handle_backup_database(self):
+        """Start an online backup in the background; progress via /api/database/backups"""
+        try:
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            zip_path = os.path.join(BACKUP_DIR, f'surgery_backup_{timestamp}.db.zip')
             
-            os.remove(backup_file)
+            def backup(job):
+                job.filename = write_backup_zip(zip_path, job)
+                job.message = '数据库备份成功'
             
+            job = maintenance_jobs.submit('backup', backup, '备份失败')
             self.send_json({
                 'success': True,
-                'message': '数据库备份成功',
-                'backup_file': os.path.basename(zip_file)
+                'message': '备份已开始',
+                'job': job.to_dict()
             })
         except Exception as e:
             self.send_json({
@@ -476,27 +3264,16 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
     def handle_db_maintenance(self):
         """Handle database maintenance operations"""
         try:
-            parsed_path = urlparse(self.path)
-            params = parse_qs(parsed_path.query)
-            operation = params.get('operation', [''])[0]
+            operation = self.params.get('operation', [''])[0]
             
             if not operation:
                 raise ValueError("No operation specified")
+            handler = MAINTENANCE_OPERATIONS.get(operation)
+            if handler is None:
+                raise ValueError(f"Invalid maintenance operation: {operation}")
                 
             logging.info(f"Performing maintenance operation: {operation}")
-        
-            if operation == 'vacuum':
-                self.handle_vacuum_db()
-            elif operation == 'archive':
-                self.handle_archive_data()
-            elif operation == 'add_indexes':
-                self.handle_add_indexes()
-            elif operation == 'analyze':
-                self.handle_analyze_db()
-            elif operation == 'reset':
-                self.handle_reset_database()
-            else:
-                raise ValueError(f"Invalid maintenance operation: {operation}")
+            handler(self)
                 
         except Exception as e:
             logging.error(f"Maintenance operation failed: {str(e)}")
@@ -508,11 +3285,9 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
     def handle_vacuum_db(self):
         """Vacuum the database to reclaim space and defragment"""
         try:
-            # Close all connections before vacuum
-            conn = sqlite3.connect(DB_PATH)
-            conn.isolation_level = None  # This is required for vacuum
-            conn.execute("VACUUM")
-            conn.close()
+            # VACUUM cannot run inside a transaction, so borrow the writer connection
+            with get_db_writer().exclusive() as conn:
+                conn.execute("VACUUM")
             
             self.send_json({
                 'success': True,
@@ -526,61 +3301,29 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
             })
 
     def handle_archive_data(self):
-        """Archive old surgery records"""
+        """Archive old surgery records in the background.
+
+        ``before`` (YYYY-MM-DD) or ``days`` sets the cutoff (default
+        ARCHIVE_DEFAULT_DAYS); ``mode`` picks the destination (ARCHIVE_MODES).
+        An interrupted run is resumed first.
+        """
+        params = self.params
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            
-            # Create archive table if it doesn't exist
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS SurgeryScheduleArchive (
-                    ID INTEGER PRIMARY KEY AUTOINCREMENT,
-                    Department TEXT NOT NULL,
-                    Date TEXT NOT NULL,
-                    BedNumber TEXT NOT NULL,
-                    PatientName TEXT NOT NULL,
-                    Gender TEXT NOT NULL,
-                    Age INTEGER NOT NULL,
-                    HospitalNumber TEXT NOT NULL,
-                    Diagnosis TEXT NOT NULL,
-                    Operation TEXT NOT NULL,
-                    MainSurgeon TEXT NOT NULL,
-                    Assistant TEXT NOT NULL,
-                    AnesthesiaDoctor TEXT NOT NULL,
-                    AnesthesiaType TEXT NOT NULL,
-                    PreOpPrep TEXT,
-                    OperationOrder INTEGER NOT NULL,
-                    Creator TEXT NOT NULL,
-                    Editor TEXT NOT NULL,
-                    CreatedAt TIMESTAMP,
-                    UpdatedAt TIMESTAMP
-                )
-            ''')
-            
-            # Calculate date threshold (e.g., 1 year ago)
-            archive_date = (datetime.now() - timedelta(days=365)).strftime('%Y-%m-%d')
-            
-            # Move old records to archive
-            cursor.execute('''
-                INSERT INTO SurgeryScheduleArchive
-                SELECT * FROM SurgerySchedule
-                WHERE Date < ?
-                AND ID NOT IN (SELECT ID FROM SurgeryScheduleArchive)
-            ''', (archive_date,))
-            
-            # Get count of archived records
-            archived_count = cursor.rowcount
-            
-            # Delete archived records from main table
-            if archived_count > 0:
-                cursor.execute('DELETE FROM SurgerySchedule WHERE Date < ?', (archive_date,))
-            
-            conn.commit()
-            conn.close()
+            before = params.get('before', [''])[0]
+            if before:
+                datetime.strptime(before, '%Y-%m-%d')
+            else:
+                days = int(params.get('days', [ARCHIVE_DEFAULT_DAYS])[0])
+                before = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+            mode = params.get('mode', [ARCHIVE_MODE])[0]
+            if mode not in ARCHIVE_MODES:
+                raise ValueError(f'不支持的归档方式: {mode}')
             
+            job, resumed = start_archive(before, mode)
             self.send_json({
                 'success': True,
-                'message': f'已归档 {archived_count} 条记录'
+                'message': '继续未完成的归档任务' if resumed else f'开始归档 {before} 之前的记录',
+                'job': job.to_dict()
             })
         except Exception as e:
             logging.error(f"Archive failed: {str(e)}")
@@ -590,22 +3333,15 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
             })
 
     def handle_add_indexes(self):
-        """Add indexes to improve query performance"""
+        """Apply any pending schema migrations (which create the indexes)"""
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            
-            # Add commonly used indexes
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_surgery_date ON SurgerySchedule(Date)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_surgery_dept ON SurgerySchedule(Department)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_surgery_date_dept ON SurgerySchedule(Date, Department)')
-            
-            conn.commit()
-            conn.close()
+            with get_db_writer().exclusive() as conn:
+                schema_version = run_migrations(conn)
             
             self.send_json({
                 'success': True,
-                'message': '索引添加成功'
+                'message': '索引添加成功',
+                'schemaVersion': schema_version
             })
         except Exception as e:
             self.send_json({
@@ -616,11 +3352,8 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
     def handle_analyze_db(self):
         """Analyze the database to update statistics"""
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            cursor.execute('ANALYZE')
-            conn.commit()
-            conn.close()
+            with get_db_writer().exclusive() as conn:
+                conn.execute('ANALYZE')
             
             self.send_json({
                 'success': True,
@@ -633,40 +3366,50 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
             })
 
     def handle_get_db_stats(self):
-        """Get database statistics"""
+        """Get database statistics (from the summary tables and PRAGMAs, no table scans)"""
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            
-            # Get total records
-            cursor.execute('SELECT COUNT(*) FROM SurgerySchedule')
-            total_records = cursor.fetchone()[0]
-            
-            # Get archived records (handle case where table might not exist)
-            try:
-                cursor.execute('SELECT COUNT(*) FROM SurgeryScheduleArchive')
-                archived_records = cursor.fetchone()[0]
-            except sqlite3.OperationalError:
-                archived_records = 0
-            
-            # Get oldest record date
-            cursor.execute('SELECT MIN(Date) FROM SurgerySchedule')
-            oldest_record = cursor.fetchone()[0] or '-'
-            
-            # Get database size
-            db_size = os.path.getsize(DB_PATH)
-            db_size_mb = round(db_size / (1024 * 1024), 2)
+            with get_db_pool().get_connection() as conn:
+                cursor = conn.cursor()
+                counts = dict(cursor.execute('SELECT Name, Count FROM TableCounts').fetchall())
+                departments = dict(cursor.execute('SELECT Department, Count FROM DepartmentCounts').fetchall())
+                oldest_record, newest_record = cursor.execute('SELECT MIN(Date), MAX(Date) FROM DailyCounts').fetchone()
+                
+                # Scheduled surgeries for the next two weeks, per day and department
+                today = datetime.now()
+                upcoming = {}
+                for date, department, count in cursor.execute(
+                        'SELECT Date, Department, Count FROM DailyCounts WHERE Date >= ? AND Date < ?',
+                        (today.strftime('%Y-%m-%d'), (today + timedelta(days=14)).strftime('%Y-%m-%d'))):
+                    upcoming.setdefault(date, {})[department] = count
+                
+                page_size = cursor.execute('PRAGMA page_size').fetchone()[0]
+                page_count = cursor.execute('PRAGMA page_count').fetchone()[0]
+                freelist_count = cursor.execute('PRAGMA freelist_count').fetchone()[0]
             
-            conn.close()
+            wal_path = DB_PATH + '-wal'
+            wal_size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
             
             self.send_json({
                 'success': True,
                 'stats': {
-                    'totalRecords': total_records,
-                    'archivedRecords': archived_records,
-                    'oldestRecord': oldest_record,
-                    'dbSize': f'{db_size_mb} MB'
-                }
+                    'totalRecords': counts.get('SurgerySchedule', 0),
+                    'archivedRecords': counts.get('archived', 0),
+                    'oldestRecord': oldest_record or '-',
+                    'newestRecord': newest_record or '-',
+                    'dbSize': f'{round(page_count * page_size / (1024 * 1024), 2)} MB',
+                    'walSize': f'{round(wal_size / (1024 * 1024), 2)} MB',
+                    'pageSize': page_size,
+                    'pageCount': page_count,
+                    'freelistCount': freelist_count,
+                    'departments': departments,
+                    'upcoming': upcoming
+                },
+                'pool': get_db_pool().get_stats(),
+                'scheduleCache': schedule_cache.get_stats(),
+                'events': event_broker.get_stats(),
+                'writer': get_db_writer().get_stats(),
+                'accessLog': access_log.get_stats(),
+                'server': self.server.get_stats() if hasattr(self.server, 'get_stats') else None
             })
         except Exception as e:
             logging.error(f"Get stats failed: {str(e)}")
@@ -676,78 +3419,134 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
             })
 
     def handle_get_backups(self):
-        """Get list of database backups"""
+        """Get the backup chain (full snapshots and incremental backups) and running jobs"""
+        try:
+            backups = list_backups()
+            self.send_json({
+                'success': True,
+                'backups': [{
+                    'filename': backup['filename'],
+                    'size': backup['size'],
+                    'bytes': backup['bytes'],
+                    'type': backup['type'],
+                    'created': backup['created'],
+                    'base': backup.get('base'),
+                    'automatic': backup['automatic'],
+                } for backup in backups],
+                'jobs': maintenance_jobs.list()
+            })
+        except Exception as e:
+            self.send_json({
+                'success': False,
+                'message': str(e)
+            })
+
+    def handle_restore_backup(self):
+        """Restore a backup (``filename``) or the state at a point in time (``time``)"""
+        data = self.read_json()
+        
         try:
-            os.makedirs(BACKUP_DIR, exist_ok=True)
-            backups = []
+            if not data.get('filename') and not data.get('time'):
+                raise ValueError('未指定备份文件或恢复时间')
+            chain = choose_restore_point(data.get('filename'), data.get('time'))
             
-            for filename in os.listdir(BACKUP_DIR):
-                if filename.endswith('.zip'):
-                    path = os.path.join(BACKUP_DIR, filename)
-                    size = os.path.getsize(path)
-                    size_mb = round(size / (1024 * 1024), 2)
-                    backups.append({
-                        'filename': filename,
-                        'size': f'{size_mb} MB'
-                    })
+            def restore(job):
+                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+                restored_path = os.path.join(BACKUP_DIR, f'restore_{timestamp}.db.part')
+                try:
+                    build_restored_database(chain, restored_path)
+                    job.progress = 30
+                    # Keep what is being replaced
+                    write_backup_zip(os.path.join(BACKUP_DIR, f'pre_restore_backup_{timestamp}.db.zip'))
+                    swap_database(restored_path)
+                finally:
+                    if os.path.exists(restored_path):
+                        os.remove(restored_path)
+                job.filename = chain[-1]['filename']
+                job.message = f'数据库已恢复到 {chain[-1]["created"]}'
+                logging.info(f"Database restored from {' + '.join(b['filename'] for b in chain)}")
             
+            job = maintenance_jobs.submit('restore', restore, '恢复失败')
             self.send_json({
                 'success': True,
-                'backups': sorted(backups, key=lambda x: x['filename'], reverse=True)
+                'message': '恢复已开始',
+                'job': job.to_dict()
             })
         except Exception as e:
             self.send_json({
                 'success': False,
-                'message': str(e)
+                'message': f'恢复失败: {str(e)}'
             })
 
     def handle_import_backup(self):
-        """Import database backup"""
+        """Restore an uploaded backup (.zip or .db).
+
+        The upload is streamed to a file in the request. Checking it and
+        swapping it in runs as a background job; /api/database/backups
+        reports its progress.
+        """
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        upload_path = os.path.join(BACKUP_DIR, f'import_{timestamp}.upload.part')
+        database_path = os.path.join(BACKUP_DIR, f'import_{timestamp}.db.part')
         try:
             content_length = int(self.headers['Content-Length'])
-            if content_length > 50 * 1024 * 1024:  # 50MB limit
-                raise ValueError("Backup file too large")
-            
-            # Read the multipart form data
-            # Implementation depends on how you handle file uploads
-            # This is a simplified version
-            
-            # Backup current database
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            backup_path = os.path.join(BACKUP_DIR, f'pre_import_backup_{timestamp}.db')
-            shutil.copy2(DB_PATH, backup_path)
+            with open(upload_path, 'wb') as upload:
+                filename = save_multipart_file(self.rfile, self.headers.get('Content-Type'),
+                                               content_length, 'backup', upload)
             
-            # Process the uploaded file and restore database
-            # Implementation needed here
+            def restore(job):
+                try:
+                    unpack_uploaded_backup(upload_path, database_path)
+                    check_database_file(database_path)
+                    job.progress = 30
+                    prepare_restored_database(database_path)
+                    job.progress = 40
+                    # Keep what is being replaced
+                    write_backup_zip(os.path.join(BACKUP_DIR, f'pre_import_backup_{timestamp}.db.zip'))
+                    job.progress = 90
+                    swap_database(database_path)
+                finally:
+                    for path in (upload_path, database_path):
+                        if os.path.exists(path):
+                            os.remove(path)
+                job.filename = filename
+                job.message = '数据库已从备份恢复'
+                logging.info(f'Database restored from uploaded backup {filename}')
             
-            logging.info('Database restored from backup')
+            job = maintenance_jobs.submit('import', restore, '导入失败')
             self.send_json({
                 'success': True,
-                'message': '数据库已从备份恢复'
+                'message': '备份已上传，正在恢复',
+                'job': job.to_dict()
             })
         except Exception as e:
+            if os.path.exists(upload_path):
+                os.remove(upload_path)
             self.send_json({
                 'success': False,
                 'message': str(e)
             })
 
     def handle_get_logs(self):
-        """Get system logs"""
-        try:
-            with open(LOG_FILE, 'r', encoding='utf-8') as f:
-                logs = []
-                for line in f.readlines()[-100:]:  # Get last 100 lines
-                    parts = line.split(' - ', 1)
-                    if len(parts) == 2:
-                        timestamp, message = parts
-                        logs.append({
-                            'timestamp': timestamp.strip(),
-                            'message': message.strip()
-                        })
+        """Get system logs, newest page first.
+
+        Filters: ``level`` (minimum level), ``since`` (YYYY-MM-DD[ HH:MM:SS])
+        and ``q`` (text). Pass the returned ``cursor`` back to get older entries.
+        """
+        params = self.params
+        try:
+            limit = min(int(params.get('limit', [LOG_PAGE_SIZE])[0]), LOG_PAGE_MAX)
+            logs, cursor = read_logs(
+                limit,
+                level=params.get('level', [''])[0] or None,
+                since=params.get('since', [''])[0].replace('T', ' ') or None,
+                query=params.get('q', [''])[0] or None,
+                cursor=params.get('cursor', [''])[0] or None)
             
             self.send_json({
                 'success': True,
-                'logs': logs
+                'logs': logs,
+                'cursor': cursor
             })
         except Exception as e:
             self.send_json({
@@ -756,10 +3555,9 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
             })
 
     def handle_clear_logs(self):
-        """Clear system logs"""
+        """Clear system logs by rotating to a new file (older files age out with rotation)"""
         try:
-            with open(LOG_FILE, 'w') as f:
-                f.write('')
+            log_handler.rotate_now()
             
             self.send_json({
                 'success': True,
@@ -771,25 +3569,45 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
                 'message': str(e)
             })
 
+    def handle_metrics(self):
+        """Prometheus text exposition of the metrics registry"""
+        self.send_body(metrics.render().encode(), 'text/plain; version=0.0.4; charset=utf-8')
+
+    def handle_get_access_log(self):
+        self.send_json({'success': True, 'accessLog': access_log.get_stats()})
+
+    def handle_configure_access_log(self):
+        """Switch the access log on/off or change its sample rate without a restart"""
+        try:
+            data = self.read_json()
+            sample_rate = data.get('sampleRate')
+            access_log.configure(
+                enabled=bool(data['enabled']) if 'enabled' in data else None,
+                sample_rate=float(sample_rate) if sample_rate is not None else None)
+            self.send_json({
+                'success': True,
+                'message': '访问日志设置已更新',
+                'accessLog': access_log.get_stats()
+            })
+        except (ValueError, TypeError) as e:
+            self.send_json({
+                'success': False,
+                'message': str(e)
+            })
+
     def handle_admin_login(self):
         """Handle admin login"""
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length).decode('utf-8')
-        data = json.loads(post_data)
+        data = self.read_json()
         
         username = data.get('username')
         password = data.get('password')
         
         if username == DB_MAINTENANCE_USERNAME and password == DB_MAINTENANCE_PASSWORD:
             # Set cookie for authentication
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Set-Cookie', 'admin_auth=true; Path=/')
-            self.end_headers()
-            self.wfile.write(json.dumps({
+            self.send_body(json.dumps({
                 'success': True,
                 'message': '登录成功'
-            }).encode())
+            }).encode(), 'application/json', {'Set-Cookie': 'admin_auth=true; Path=/'})
         else:
             self.send_json({
                 'success': False,
@@ -805,30 +3623,21 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
         """Redirect to admin login page"""
         self.send_response(302)
         self.send_header('Location', '/admin/login')
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
     def send_file(self, filename):
         try:
             if filename.startswith('templates/'):
                 # Handle template files
-                template_name = os.path.basename(filename)
-                content = load_template(template_name)
-                self.send_response(200)
-                self.send_header('Content-type', 'text/html; charset=utf-8')
-                self.end_headers()
-                self.wfile.write(content.encode('utf-8'))
-            else:
+                template = template_cache.get(os.path.basename(filename))
+                self.send_cached(template, TEMPLATE_CACHE_CONTROL)
+            elif filename.startswith('static/'):
                 # Handle other static files
-                filepath = filename
-                with open(filepath, 'rb') as f:
-                    content = f.read()
-                    self.send_response(200)
-                    if filename.endswith('.js'):
-                        self.send_header('Content-type', 'application/javascript')
-                    elif filename.endswith('.css'):
-                        self.send_header('Content-type', 'text/css')
-                    self.end_headers()
-                    self.wfile.write(content)
+                entry = static_cache.get(filename[len('static/'):])
+                self.send_cached(entry, f'public, max-age={STATIC_MAX_AGE}')
+            else:
+                raise FileNotFoundError(filename)
         except FileNotFoundError:
             print(f"File not found: {filename}")
             self.send_error(404)
@@ -836,48 +3645,139 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
             print(f"Error sending file {filename}: {str(e)}")
             self.send_error(500)
 
-    def send_json(self, data):
+    def is_not_modified(self, etag, mtime):
+        """Evaluate If-None-Match / If-Modified-Since against a file version"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            if if_none_match.strip() == '*':
+                return True
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return etag in tags or 'W/' + etag in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            if since is None:
+                return False
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def choose_encoding(self, size, content_type):
+        """Pick gzip or deflate from Accept-Encoding, or None to send identity"""
+        if size < COMPRESSION_MIN_SIZE or not is_compressible(content_type):
+            return None
+        accepted = {}
+        for item in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = item.strip().partition(';')
+            quality = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            accepted[name.strip().lower()] = quality
+        for encoding in ('gzip', 'deflate'):
+            if accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+        return None
+
+    def send_cached(self, entry, cache_control):
+        """Send a cached file, or 304 when the client already has this version"""
+        encoding = self.choose_encoding(len(entry.body), entry.content_type)
+        body, etag = entry.encoded(encoding)
+        not_modified = self.is_not_modified(etag, entry.mtime)
+        if not_modified:
+            self.send_response(304)
+        else:
+            self.send_response(200)
+            self.send_header('Content-type', entry.content_type)
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+            self.send_header('Content-Length', str(len(body)))
+        if is_compressible(entry.content_type):
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(int(entry.mtime)))
+        self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+        if not not_modified:
+            self.wfile.write(body)
+
+    def start_chunked(self, content_type, headers=None):
+        """Send the headers of a streamed response and return a ChunkedWriter for its body"""
+        encoding = self.choose_encoding(COMPRESSION_MIN_SIZE, content_type)
+        chunked = self.request_version == 'HTTP/1.1'
         self.send_response(200)
-        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-type', content_type)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if is_compressible(content_type):
+            self.send_header('Vary', 'Accept-Encoding')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            # HTTP/1.0 clients learn the end of the body from the connection closing
+            self.close_connection = True
+            self.send_header('Connection', 'close')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        return ChunkedWriter(self.wfile, encoding, chunked)
+
+    def send_body(self, body, content_type, headers=None, status=200):
+        """Send a complete response body, compressed when the client allows it"""
+        encoding = self.choose_encoding(len(body), content_type)
+        if encoding:
+            body = compress_body(body, encoding)
+        self.write_response(status, body, content_type, encoding, headers)
+
+    def send_entry(self, entry, headers=None, status=200):
+        """Send a CachedBody, reusing its already compressed variant"""
+        encoding = self.choose_encoding(len(entry.body), entry.content_type)
+        body, _ = entry.encoded(encoding)
+        self.write_response(status, body, entry.content_type, encoding, headers)
+
+    def write_response(self, status, body, content_type, encoding=None, headers=None):
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if is_compressible(content_type):
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
+
+    def send_json(self, data):
+        self.send_body(json.dumps(data).encode(), 'application/json')
 
     def handle_reset_database(self):
-        """Backup current database and create a new clean one"""
+        """Backup current database and create a new clean one (as a background job)"""
         try:
-            # 1. Create backup of current database
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            backup_dir = os.path.join(BASE_DIR, 'backups')
-            backup_file = os.path.join(backup_dir, f'full_backup_{timestamp}.db')
-            
-            # Ensure backup directory exists
-            os.makedirs(backup_dir, exist_ok=True)
-            
-            # Copy current database to backup
-            shutil.copy2(DB_PATH, backup_file)
-            
-            # 2. Create zip of backup
-            zip_file = backup_file + '.zip'
-            with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                zipf.write(backup_file, os.path.basename(backup_file))
+            zip_path = os.path.join(BACKUP_DIR, f'full_backup_{timestamp}.db.zip')
             
-            # Remove unzipped backup
-            os.remove(backup_file)
-            
-            # 3. Remove current database
-            os.remove(DB_PATH)
-            
-            # 4. Initialize new clean database
-            init_db()
+            def reset(job):
+                # 1. Online backup of the current database
+                job.filename = write_backup_zip(zip_path, job)
+                
+                # 2. Hold off writes, retire pooled connections and start a new clean database
+                swap_database()
+                
+                job.message = f'数据库已重置。旧数据已备份为: {job.filename}'
+                logging.info(f"Database reset completed. Backup created: {job.filename}")
             
+            job = maintenance_jobs.submit('reset', reset, '数据库重置失败')
             self.send_json({
                 'success': True,
-                'message': f'数据库已重置。旧数据已备份为: {os.path.basename(zip_file)}',
-                'backup_file': os.path.basename(zip_file)
+                'message': '数据库重置已开始',
+                'job': job.to_dict()
             })
-            
-            logging.info(f"Database reset completed. Backup created: {os.path.basename(zip_file)}")
-            
         except Exception as e:
             logging.error(f"Database reset failed: {str(e)}")
             self.send_json({
@@ -885,14 +3785,440 @@ class SurgeryHandler(http.server.SimpleHTTPRequestHandler):
                 'message': f'数据库重置失败: {str(e)}'
             })
 
+router = Router()
+router.add('/', GET=SurgeryHandler.handle_index)
+router.add('/admin/login', GET=SurgeryHandler.handle_admin_login_page)
+router.add('/db/maintenance', admin=True, GET=SurgeryHandler.handle_maintenance_page)
+router.add('/static/*', GET=SurgeryHandler.handle_static)
+router.add('/api/surgery/login', POST=SurgeryHandler.handle_surgery_login)
+router.add('/api/admin/login', POST=SurgeryHandler.handle_admin_login)
+router.add('/api/surgeries', GET=SurgeryHandler.handle_get_surgeries)
+router.add('/api/surgeries/export', GET=SurgeryHandler.handle_export_surgeries)
+router.add('/api/surgeries/history', GET=SurgeryHandler.handle_get_history)
+router.add('/api/surgeries/batch', GET=SurgeryHandler.handle_get_surgeries_batch)
+router.add('/api/surgery/add', POST=SurgeryHandler.handle_add_surgery)
+router.add('/api/surgery/edit', POST=SurgeryHandler.handle_edit_surgery)
+router.add('/api/surgery/batch', POST=SurgeryHandler.handle_surgery_batch)
+router.add('/api/surgery/delete', POST=SurgeryHandler.handle_delete_surgery)
+router.add('/api/events', GET=SurgeryHandler.handle_events)
+router.add('/api/db/maintenance', GET=SurgeryHandler.handle_db_maintenance)
+router.add('/api/db/stats', GET=SurgeryHandler.handle_get_db_stats)
+router.add('/api/database/backups', GET=SurgeryHandler.handle_get_backups)
+router.add('/api/database/backup', POST=SurgeryHandler.handle_backup_database)
+router.add('/api/database/restore', POST=SurgeryHandler.handle_restore_backup)
+router.add('/api/database/import', body_limit=BACKUP_UPLOAD_MAX, stream_body=True, POST=SurgeryHandler.handle_import_backup)
+router.add('/api/database/logs', GET=SurgeryHandler.handle_get_logs)
+router.add('/api/database/logs/clear', POST=SurgeryHandler.handle_clear_logs)
+router.add('/metrics', GET=SurgeryHandler.handle_metrics)
+router.add('/api/database/access-log', GET=SurgeryHandler.handle_get_access_log, POST=SurgeryHandler.handle_configure_access_log)
+
+# ?operation= values of /api/db/maintenance
+MAINTENANCE_OPERATIONS = {
+    'vacuum': SurgeryHandler.handle_vacuum_db,
+    'archive': SurgeryHandler.handle_archive_data,
+    'add_indexes': SurgeryHandler.handle_add_indexes,
+    'analyze': SurgeryHandler.handle_analyze_db,
+    'reset': SurgeryHandler.handle_reset_database,
+}
+
+@metrics.collector
+def collect_database_metrics():
+    sizes = [('surgery_db_size_bytes', 'Size of the database file', DB_PATH),
+             ('surgery_db_wal_size_bytes', 'Size of the write-ahead log', DB_PATH + '-wal')]
+    collected = [(name, 'gauge', help_text, (), [((), os.path.getsize(path) if os.path.exists(path) else 0)])
+                 for name, help_text, path in sizes]
+    if _db_pool is not None:
+        stats = _db_pool.get_stats()
+        collected += [
+            ('surgery_db_pool_connections', 'gauge', 'Pooled SQLite connections', ('state',),
+             [(('active',), stats['active']), (('idle',), stats['idle']), (('open',), stats['open'])]),
+            ('surgery_db_pool_checkouts_total', 'counter', 'Connections handed out by the pool', (),
+             [((), stats['checkouts'])]),
+            ('surgery_db_pool_waits_total', 'counter', 'Checkouts that had to wait for a free connection', (),
+             [((), stats['waits'])]),
+            ('surgery_db_pool_timeouts_total', 'counter', 'Checkouts that gave up waiting', (),
+             [((), stats['timeouts'])]),
+        ]
+    if _db_writer is not None:
+        stats = _db_writer.get_stats()
+        collected += [
+            ('surgery_db_writer_queued', 'gauge', 'Writes waiting for the writer thread', (), [((), stats['queued'])]),
+            ('surgery_db_writer_jobs_total', 'counter', 'Writes committed or failed by the writer', (),
+             [((), stats['jobs'])]),
+            ('surgery_db_writer_batches_total', 'counter', 'Transactions run by the writer', (),
+             [((), stats['batches'])]),
+        ]
+    return collected
+
+@metrics.collector
+def collect_process_metrics():
+    cache = schedule_cache.get_stats()
+    return [
+        ('surgery_schedule_cache_requests_total', 'counter', 'Schedule cache lookups', ('result',),
+         [(('hit',), cache['hits']), (('miss',), cache['misses'])]),
+        ('surgery_schedule_cache_hit_ratio', 'gauge', 'Share of schedule cache lookups that hit', (),
+         [((), cache['hit_ratio'])]),
+        ('surgery_schedule_cache_entries', 'gauge', 'Schedules held in the cache', (), [((), cache['entries'])]),
+        ('surgery_event_clients', 'gauge', 'Connected /api/events streams', (),
+         [((), event_broker.get_stats()['clients'])]),
+        ('surgery_threads', 'gauge', 'Live Python threads', (), [((), threading.active_count())]),
+    ]
+
 class ThreadedHTTPServer(ThreadingMixIn, socketserver.TCPServer):
     daemon_threads = True
     allow_reuse_address = True
 
-def run_server():
+class PooledHTTPServer(socketserver.TCPServer):
+    """HTTP server that serves connections from a fixed set of worker threads.
+
+    Accepted connections wait in a bounded queue; when it is full the
+    connection is answered with 503 and Retry-After straight from the
+    accept loop instead of spawning yet another thread.
+    """
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers=SERVER_WORKERS, queue_size=SERVER_QUEUE_SIZE):
+        super().__init__(server_address, handler_class)
+        self.connections = queue.Queue(maxsize=queue_size)
+        self.stats = {'accepted': 0, 'rejected': 0, 'busy_workers': 0}
+        self.stats_lock = threading.Lock()
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, name=f'http-worker-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        try:
+            self.connections.put_nowait((request, client_address))
+            with self.stats_lock:
+                self.stats['accepted'] += 1
+        except queue.Full:
+            self.reject_request(request)
+
+    def reject_request(self, request):
+        with self.stats_lock:
+            self.stats['rejected'] += 1
+        body = json.dumps({'success': False, 'message': '服务器繁忙，请稍后重试'}).encode()
+        try:
+            request.setblocking(False)
+            try:
+                request.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                pass
+            request.setblocking(True)
+            request.sendall(
+                b'HTTP/1.1 503 Service Unavailable\r\n'
+                b'Content-Type: application/json\r\n'
+                + f'Retry-After: {SERVER_RETRY_AFTER}\r\n'.encode()
+                + f'Content-Length: {len(body)}\r\n'.encode()
+                + b'Connection: close\r\n\r\n' + body)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def is_busy(self):
+        """True when connections are waiting for a free worker"""
+        return not self.connections.empty()
+
+    def _work(self):
+        while True:
+            item = self.connections.get()
+            if item is None:
+                break
+            request, client_address = item
+            with self.stats_lock:
+                self.stats['busy_workers'] += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self.stats_lock:
+                    self.stats['busy_workers'] -= 1
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['workers'] = len(self.workers)
+        stats['queued'] = self.connections.qsize()
+        return stats
+
+    def server_close(self):
+        super().server_close()
+        for _ in self.workers:
+            try:
+                self.connections.put_nowait(None)
+            except queue.Full:
+                break
+
+SERVER_CLASSES = {
+    'pool': PooledHTTPServer,
+    'threaded': ThreadedHTTPServer,
+}
+
+class LoopWriter(io.RawIOBase):
+    """File-like ``wfile`` that lets an executor thread write to an asyncio stream.
+
+    Every write is handed to the event loop and waits for ``drain()``, so a
+    slow client pushes back on the handler instead of buffering unboundedly.
+    """
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self.loop).result()
+        return len(data)
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+class LoopReader(io.RawIOBase):
+    """File-like ``rfile`` that lets an executor thread read a request from an asyncio stream.
+
+    The already-read request head comes first, then at most ``length`` body
+    bytes are pulled from the stream as the handler asks for them, so an
+    upload is never held in memory whole.
+    """
+
+    def __init__(self, loop, reader, head, length):
+        self.loop = loop
+        self.reader = reader
+        self.head = head
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.head:
+            size = min(len(buffer), len(self.head))
+            buffer[:size] = self.head[:size]
+            self.head = self.head[size:]
+            return size
+        if self.remaining <= 0:
+            return 0
+        data = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(self.reader.read(min(len(buffer), self.remaining)), KEEPALIVE_TIMEOUT),
+            self.loop).result()
+        if not data:
+            raise ConnectionError('Client closed the connection during the upload')
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+class AsyncHTTPServer:
+    """Stdlib asyncio front end for SurgeryHandler.
+
+    Connections, keep-alive and pipelined requests are handled on the event
+    loop, so idle and slow clients only cost a coroutine. Each complete
+    request is then run through the normal handler in a thread pool, which
+    is where the SQLite work happens. Paths registered in ``async_routes``
+    are served by a coroutine on the loop instead, for long-lived push
+    connections that should not occupy an executor thread.
+    """
+
+    def __init__(self, server_address, handler_class, workers=SERVER_WORKERS, queue_size=SERVER_QUEUE_SIZE):
+        self.server_address = server_address
+        self.handler_class = handler_class
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='http-worker')
+        self.workers = workers
+        self.queue_size = queue_size
+        self.async_routes = {}
+        self.stats = {'connections': 0, 'open_connections': 0, 'requests': 0, 'in_flight': 0, 'rejected': 0}
+        self.loop = None
+
+    async def serve_forever(self):
+        self.loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(self.workers + self.queue_size)
+        host, port = self.server_address
+        server = await asyncio.start_server(self.handle_connection, host or None, port)
+        async with server:
+            await server.serve_forever()
+
+    def server_close(self):
+        self.executor.shutdown(wait=False)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['workers'] = self.workers
+        return stats
+
+    async def read_request(self, reader, writer):
+        """Read one request (head and body); returns None when the connection is done.
+
+        The body of a ``stream_body`` route is not read here; a LoopReader
+        takes its place and hands it to the handler as it is consumed.
+        """
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEPALIVE_TIMEOUT)
+        except asyncio.LimitOverrunError:
+            writer.write(b'HTTP/1.1 431 Request Header Fields Too Large\r\n'
+                         b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+            return None
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            return None
+
+        headers = {}
+        for line in head.decode('latin-1').split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            if name:
+                headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            return None
+        path = urlparse(head.split(b' ', 2)[1].decode('latin-1')).path if head.count(b' ') >= 2 else ''
+        route = router.match(path)
+        if length > (route.body_limit if route is not None else REQUEST_BODY_MAX):
+            # Refuse before buffering the body in memory
+            body = json.dumps({'success': False, 'message': '请求内容过大'}).encode()
+            writer.write(b'HTTP/1.1 413 Payload Too Large\r\nContent-Type: application/json\r\n'
+                         + f'Content-Length: {len(body)}\r\n'.encode() + b'Connection: close\r\n\r\n' + body)
+            return None
+        if headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        if route is not None and route.stream_body and length > 0:
+            return head, LoopReader(self.loop, reader, head, length), headers
+        try:
+            body = await reader.readexactly(length) if length > 0 else b''
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        return head, body, headers
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info('peername') or ('', 0)
+        self.stats['connections'] += 1
+        self.stats['open_connections'] += 1
+        try:
+            while True:
+                request = await self.read_request(reader, writer)
+                if request is None:
+                    break
+                head, body, headers = request
+                self.stats['requests'] += 1
+
+                path = urlparse(head.split(b' ', 2)[1].decode('latin-1')).path if head.count(b' ') >= 2 else ''
+                if path in self.async_routes:
+                    await self.async_routes[path](self, head, headers, reader, writer)
+                    break
+
+                if self.slots.locked():
+                    self.stats['rejected'] += 1
+                    body = json.dumps({'success': False, 'message': '服务器繁忙，请稍后重试'}).encode()
+                    writer.write(b'HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n'
+                                 + f'Retry-After: {SERVER_RETRY_AFTER}\r\nContent-Length: {len(body)}\r\n'.encode()
+                                 + b'Connection: close\r\n\r\n' + body)
+                    break
+
+                async with self.slots:
+                    self.stats['in_flight'] += 1
+                    try:
+                        rfile = io.BufferedReader(body) if isinstance(body, LoopReader) else io.BytesIO(head + body)
+                        keep_alive = await self.loop.run_in_executor(
+                            self.executor, self.run_handler, rfile, writer, peer)
+                    finally:
+                        self.stats['in_flight'] -= 1
+                # The rest of an unread streamed body would be taken for the next request
+                if not keep_alive or (isinstance(body, LoopReader) and body.remaining):
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.stats['open_connections'] -= 1
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def run_handler(self, rfile, writer, peer):
+        """Run one request through the regular handler; returns True to keep the connection"""
+        handler = self.handler_class.__new__(self.handler_class)
+        handler.server = self
+        handler.request = None
+        handler.client_address = peer[:2]
+        handler.directory = STATIC_DIR
+        handler.rfile = rfile
+        handler.wfile = LoopWriter(self.loop, writer)
+        handler.close_connection = True
+        try:
+            handler.handle_one_request()
+        except ConnectionError:
+            return False
+        except Exception as e:
+            logging.error(f"Request from {peer[0]} failed: {str(e)}")
+            return False
+        return not handler.close_connection
+
+async def serve_events_async(server, head, headers, reader, writer):
+    """/api/events on the asyncio engine: the stream lives on the loop, not in a thread"""
+    loop = asyncio.get_running_loop()
+    params = parse_qs(urlparse(head.split(b' ', 2)[1].decode('latin-1')).query)
+    wakeup = asyncio.Event()
+    subscription = event_broker.subscribe(
+        headers.get('last-event-id') or params.get('lastEventId', [''])[0],
+        split_param(params, 'department'),
+        notify=lambda: loop.call_soon_threadsafe(wakeup.set),
+        limit=SSE_MAX_ASYNC_CLIENTS)
+    if subscription is None:
+        writer.write(f'HTTP/1.1 503 Service Unavailable\r\nRetry-After: {SSE_HEARTBEAT}\r\n'
+                     'Content-Length: 0\r\nConnection: close\r\n\r\n'.encode())
+        return
+
+    def chunk(data):
+        return b'%x\r\n%s\r\n' % (len(data), data)
+
+    try:
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                     b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+        writer.write(chunk(f'retry: {SSE_HEARTBEAT * 1000}\n\n'.encode()))
+        await writer.drain()
+        while not subscription.overflowed:
+            try:
+                await asyncio.wait_for(wakeup.wait(), SSE_HEARTBEAT)
+            except asyncio.TimeoutError:
+                writer.write(chunk(b': heartbeat\n\n'))
+            wakeup.clear()
+            while True:
+                try:
+                    event = subscription.events.get_nowait()
+                except queue.Empty:
+                    break
+                writer.write(chunk(format_sse(*event)))
+            await writer.drain()
+        writer.write(chunk(format_sse('', 'reset', {})) + b'0\r\n\r\n')
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        event_broker.unsubscribe(subscription)
+
+def run_async_server(server):
+    try:
+        asyncio.run(server.serve_forever())
+    finally:
+        server.server_close()
+
+def run_server(mode=SERVER_MODE):
     # Initialize database and create necessary directories
     init_db()
     os.makedirs(BACKUP_DIR, exist_ok=True)
+    db_pool = get_db_pool()
+    db_writer = get_db_writer()
+    if BACKUP_SCHEDULE_ENABLED:
+        backup_scheduler.start()
+    job, _ = start_archive()
+    if job is not None:
+        print("Resuming an interrupted archive run")
     
     # Initialize logging
     if not os.path.exists(LOG_FILE):
@@ -900,13 +4226,34 @@ def run_server():
             f.write('')
     
     try:
-        with ThreadedHTTPServer(("", PORT), SurgeryHandler) as httpd:
-            print(f"Server started at http://localhost:{PORT}")
+        if mode == 'asyncio':
+            print(f"Server started at http://localhost:{PORT} ({mode} mode)")
             print("Press Ctrl+C to stop the server")
-            httpd.serve_forever()
+            server = AsyncHTTPServer(("", PORT), SurgeryHandler)
+            server.async_routes['/api/events'] = serve_events_async
+            run_async_server(server)
+        else:
+            with SERVER_CLASSES[mode](("", PORT), SurgeryHandler) as httpd:
+                print(f"Server started at http://localhost:{PORT} ({mode} mode)")
+                print("Press Ctrl+C to stop the server")
+                httpd.serve_forever()
     except KeyboardInterrupt:
         print("\nShutting down server...")
-        httpd.server_close()
+    finally:
+        # Let a running backup finish before the writer and pool go away
+        backup_scheduler.stop()
+        maintenance_jobs.shutdown()
+        db_writer.stop()
+        db_pool.close()
 
 if __name__ == '__main__':
-    run_server() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Surgery scheduling server')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--server', choices=sorted(SERVER_CLASSES) + ['asyncio'], default=SERVER_MODE,
+                        help='connection handling model')
+    parser.add_argument('--access-log-sample', type=float, default=ACCESS_LOG_SAMPLE,
+                        help='fraction of requests written to access.log (0 disables it)')
+    args = parser.parse_args()
+    PORT = args.port
+    access_log.configure(enabled=args.access_log_sample > 0, sample_rate=args.access_log_sample)
+    run_server(args.server) 
\ No newline at end of file
@@ -0,0 +1,113 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+RECORD = dict(Department='一病区', BedNumber='1', PatientName='张三', Gender='男', Age=30,
+              HospitalNumber='H1', Diagnosis='d', Operation='o', MainSurgeon='m', Assistant='a',
+              AnesthesiaDoctor='ad', AnesthesiaType='全麻', PreOpPrep='', OperationOrder=1)
+
+class BackupChainTest(unittest.TestCase):
+    """Full snapshot + incremental restore against a scratch database"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = {name: getattr(server, name) for name in
+                      ('DB_PATH', 'BACKUP_DIR', 'ARCHIVE_DIR', '_db_pool', '_db_writer')}
+        server.DB_PATH = os.path.join(self.dir, 'surgery.db')
+        server.BACKUP_DIR = os.path.join(self.dir, 'backups')
+        server.ARCHIVE_DIR = os.path.join(self.dir, 'archive')
+        os.makedirs(server.BACKUP_DIR)
+        server.init_db()
+        server._db_pool = server.DatabasePool(server.DB_PATH)
+        server._db_writer = server.DatabaseWriter(server.DB_PATH)
+
+    def tearDown(self):
+        server._db_writer.stop()
+        server._db_pool.close()
+        for name, value in self.saved.items():
+            setattr(server, name, value)
+        shutil.rmtree(self.dir)
+
+    def add(self, date, name):
+        record = dict(RECORD, Date=date, PatientName=name)
+        server.get_db_writer().execute(
+            lambda conn: conn.execute(server.INSERT_SURGERY_SQL, server.insert_params(record, 'test')))
+
+    def full_backup(self, name):
+        return server.read_backup_manifest(server.write_backup_zip(os.path.join(server.BACKUP_DIR, name)))
+
+    def restore(self, filename):
+        path = os.path.join(self.dir, 'restored.db')
+        server.build_restored_database(server.choose_restore_point(filename=filename), path)
+        conn = sqlite3.connect(path)
+        try:
+            live = sorted(row[0] for row in conn.execute('SELECT PatientName FROM SurgerySchedule'))
+            has_archive = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name='SurgeryScheduleArchive'").fetchone()
+            archived = sorted(row[0] for row in conn.execute(
+                'SELECT PatientName FROM SurgeryScheduleArchive')) if has_archive else []
+        finally:
+            conn.close()
+        return live, archived
+
+    def archive(self, cutoff):
+        job, _ = server.start_archive(cutoff, 'table')
+        while job.finished is None:
+            time.sleep(0.05)
+        self.assertEqual(job.status, 'done', job.message)
+
+    def test_incremental_restore(self):
+        self.add('2026-01-01', 'A')
+        base = self.full_backup('base.db.zip')
+        self.add('2026-01-02', 'B')
+        filename = server.write_incremental_backup(os.path.join(server.BACKUP_DIR, 'inc.zip'), base)
+        self.assertIsNotNone(filename)
+        self.assertEqual(self.restore(filename), (['A', 'B'], []))
+
+    def test_archive_after_base_forces_full_snapshot(self):
+        self.add('2024-05-01', 'old1')
+        self.add('2024-06-01', 'old2')
+        self.add('2026-01-01', 'live')
+        base = self.full_backup('base.db.zip')
+        self.archive('2025-01-01')
+        
+        # The change log only shows the archived rows as deletes
+        self.assertIsNone(server.write_incremental_backup(os.path.join(server.BACKUP_DIR, 'inc.zip'), base))
+        
+        full = self.full_backup('after_archive.db.zip')
+        self.assertEqual(self.restore(full['filename']), (['live'], ['old1', 'old2']))
+        # Incrementals against the new snapshot work again
+        self.add('2026-01-02', 'new')
+        filename = server.write_incremental_backup(os.path.join(server.BACKUP_DIR, 'inc2.zip'), full)
+        self.assertEqual(self.restore(filename), (['live', 'new'], ['old1', 'old2']))
+
+    def test_change_log_pruned_past_base_forces_full_snapshot(self):
+        saved = server.CHANGE_LOG_MAX_ROWS, server.CHANGE_LOG_PRUNE_EVERY
+        server.CHANGE_LOG_MAX_ROWS, server.CHANGE_LOG_PRUNE_EVERY = 5, 2
+        try:
+            base = self.full_backup('base.db.zip')
+            for index in range(4):
+                self.add('2026-01-01', f'P{index}')
+            filename = server.write_incremental_backup(os.path.join(server.BACKUP_DIR, 'inc.zip'), base)
+            self.assertEqual(self.restore(filename)[0], ['P0', 'P1', 'P2', 'P3'])
+            
+            for index in range(4, 20):
+                self.add('2026-01-01', f'P{index}')
+            with server.get_db_pool().get_connection() as conn:
+                entries = conn.execute('SELECT COUNT(*) FROM SurgeryChanges').fetchone()[0]
+            # Trimmed by the writer while running, not only at startup
+            self.assertLessEqual(entries, server.CHANGE_LOG_MAX_ROWS + server.CHANGE_LOG_PRUNE_EVERY)
+            self.assertIsNone(server.write_incremental_backup(os.path.join(server.BACKUP_DIR, 'inc2.zip'), base))
+        finally:
+            server.CHANGE_LOG_MAX_ROWS, server.CHANGE_LOG_PRUNE_EVERY = saved
+
+if __name__ == '__main__':
+    unittest.main()